@@ -0,0 +1,219 @@
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# Compares the sync (WSGI) and async (ASGI) serving modes under load. A fake Spotify API that answers after
+# SPOTIFY_LATENCY_SECONDS stands in for Spotify, and CONCURRENCY clients call /user/ for DURATION_SECONDS. Each mode
+# serves from a fresh process with its own temporary database. The sync mode has SERVER_THREADS request threads, the
+# async mode serves /user/ on its event loop. Needs the packages in the Pipfile's async category.
+
+USERS = 50
+CONCURRENCY = 200
+DURATION_SECONDS = 10
+SPOTIFY_LATENCY_SECONDS = 0.2
+SERVER_THREADS = 64
+SPOTIFY_PORT = 8765
+SERVER_PORT = 8766
+
+
+async def fake_spotify(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """
+    Minimal HTTP server that answers every request like Spotify's /v1/me, after a delay. Written on raw asyncio streams
+    so it takes as little of the CPU as possible away from the server being measured
+    """
+    body = b'{"id": "load-test-user", "display_name": "Load Test"}'
+    response = b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body)
+    try:
+        while True:
+            await read_http_message(reader)
+            await asyncio.sleep(SPOTIFY_LATENCY_SECONDS)
+            writer.write(response)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        writer.close()
+    except asyncio.CancelledError:
+        # the test is over. Not re-raised, asyncio logs cancelled connection handlers as errors before Python 3.12
+        writer.close()
+
+
+async def read_http_message(reader: asyncio.StreamReader) -> tuple[bytes, bytes]:
+    """
+    Reads an HTTP/1.1 request or response with a Content-Length, or no body
+    @return: The lowercased head, and the body
+    """
+    head = (await reader.readuntil(b'\r\n\r\n')).lower()
+    content_length = 0
+    for line in head.split(b'\r\n'):
+        if line.startswith(b'content-length:'):
+            content_length = int(line.split(b':', 1)[1])
+    return head, await reader.readexactly(content_length)
+
+
+def run_server(mode: str) -> None:
+    from concurrent.futures import ThreadPoolExecutor
+
+    if mode == 'async':
+        from server.asgi import asgi_app
+    from server import app, db, endpoints
+    from server.models import SpotifyToken
+
+    spotify_url = f'http://127.0.0.1:{SPOTIFY_PORT}'
+    endpoints.ME_URL = f'{spotify_url}/v1/me'
+    endpoints.TOKEN_URL = f'{spotify_url}/api/token'
+    with app.app_context():
+        db.create_all()
+        db.session.add_all(SpotifyToken(spotify_user_id=f'load-test-user-{i}', access_token='token',
+                                        refresh_token='token') for i in range(USERS))
+        db.session.commit()
+
+    if mode == 'async':
+        import uvicorn
+        uvicorn.run(asgi_app, port=SERVER_PORT, log_level='warning')
+        return
+
+    import logging
+    from werkzeug.serving import BaseWSGIServer
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    class PooledWSGIServer(BaseWSGIServer):
+        """
+        Serves requests from a fixed pool of threads, like gunicorn's threaded workers
+        """
+        multithread = True
+        executor = ThreadPoolExecutor(max_workers=SERVER_THREADS)
+
+        def process_request(self, request, client_address):
+            self.executor.submit(self.process_request_thread, request, client_address)
+
+        def process_request_thread(self, request, client_address):
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    PooledWSGIServer('127.0.0.1', SERVER_PORT, app).serve_forever()
+
+
+def read_process_stats(pid: int) -> tuple[int, float]:
+    """
+    @return: The number of threads a process has, and the CPU time it has used in seconds
+    """
+    with open(f'/proc/{pid}/status') as status:
+        threads = next(int(line.split()[1]) for line in status if line.startswith('Threads:'))
+    with open(f'/proc/{pid}/stat') as stat:
+        fields = stat.read().rsplit(')', 1)[1].split()
+    return threads, (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+async def send_request(connection: list, request: bytes) -> int:
+    """
+    Sends a request over a keep-alive connection to the server, reconnecting if the server closed it
+    @param connection: [reader, writer], or [None, None] to connect
+    @return: The response's status code
+    """
+    if connection[0] is None:
+        connection[:] = await asyncio.open_connection('127.0.0.1', SERVER_PORT)
+    reader, writer = connection
+    writer.write(request)
+    head, _ = await read_http_message(reader)
+    if b'connection: close' in head:
+        writer.close()
+        connection[:] = [None, None]
+    return int(head.split(b' ', 2)[1])
+
+
+async def generate_load(pid: int) -> None:
+    """
+    Calls /user/ from CONCURRENCY clients for DURATION_SECONDS, each over its own keep-alive connection. Uses raw
+    asyncio streams, like `fake_spotify`, so the clients take little CPU away from the server
+    """
+    from flask_jwt_extended import create_access_token
+
+    from server import app
+
+    with app.app_context():
+        requests = [f'GET /user/ HTTP/1.1\r\nHost: 127.0.0.1\r\n'
+                    f'Authorization: Bearer {create_access_token(identity=f"load-test-user-{i}")}\r\n\r\n'.encode()
+                    for i in range(USERS)]
+    while True:
+        try:
+            await send_request([None, None], requests[0])
+            break
+        except OSError:
+            await asyncio.sleep(0.2)
+
+    latencies, errors = [], []
+    max_threads, cpu_start = read_process_stats(pid)
+    stop_at = time.monotonic() + DURATION_SECONDS
+
+    async def client_loop(i: int):
+        connection = [None, None]
+        while time.monotonic() < stop_at:
+            start = time.perf_counter()
+            try:
+                status = await send_request(connection, requests[i % USERS])
+                if status != 200:
+                    errors.append(f'status {status}')
+            except (OSError, asyncio.IncompleteReadError) as e:
+                errors.append(repr(e))
+                connection = [None, None]
+            latencies.append(time.perf_counter() - start)
+            i += CONCURRENCY
+        if connection[1] is not None:
+            connection[1].close()
+
+    async def sample_threads():
+        nonlocal max_threads
+        while time.monotonic() < stop_at:
+            max_threads = max(max_threads, read_process_stats(pid)[0])
+            await asyncio.sleep(0.5)
+
+    await asyncio.gather(sample_threads(), *[client_loop(i) for i in range(CONCURRENCY)])
+    cpu_seconds = read_process_stats(pid)[1] - cpu_start
+
+    def percentile_ms(fraction: float) -> float:
+        return sorted(latencies)[min(int(len(latencies) * fraction), len(latencies) - 1)] * 1000
+
+    print(f'requests: {len(latencies) / DURATION_SECONDS:.1f}/s, p50 {percentile_ms(0.5):.1f}ms, '
+          f'p99 {percentile_ms(0.99):.1f}ms')
+    cpu_ms_per_request = cpu_seconds * 1000 / max(len(latencies), 1)
+    print(f'server: {max_threads} threads at most, {cpu_ms_per_request:.2f}ms CPU per request')
+    print(f'errors: {len(errors)}{" (" + errors[0] + ")" if errors else ""}')
+
+
+async def compare_modes() -> None:
+    spotify = await asyncio.start_server(fake_spotify, '127.0.0.1', SPOTIFY_PORT)
+    with tempfile.TemporaryDirectory() as directory:
+        for mode, description in [('sync', 'WSGI, sync views'), ('async', 'ASGI, async views')]:
+            print(f'--- {description}')
+            server = subprocess.Popen([sys.executable, __file__], env={
+                **os.environ,
+                'LOAD_TEST_MODE': mode,
+                'DATABASE_URL': f'sqlite:///{os.path.join(directory, f"load-test-{mode}.db")}',
+                'ASGI_THREADS': str(SERVER_THREADS),
+                # measure the server, not the rate limit
+                'SPOTIFY_RATE_LIMIT_PER_SECOND': '1000000',
+                'SPOTIFY_RATE_LIMIT_BURST': '1000000',
+                'SPOTIFY_POOL_SIZE': str(SERVER_THREADS),
+                'SPOTIFY_ASYNC_POOL_SIZE': str(SERVER_THREADS),
+            })
+            try:
+                await generate_load(server.pid)
+            finally:
+                server.terminate()
+                server.wait()
+    spotify.close()
+
+
+if __name__ == '__main__':
+    if 'LOAD_TEST_MODE' in os.environ:
+        run_server(os.environ['LOAD_TEST_MODE'])
+        exit()
+
+    os.environ.setdefault('SECRET_KEY', 'load-test-secret-key-that-is-long-enough')
+    asyncio.run(compare_modes())
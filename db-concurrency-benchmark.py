@@ -0,0 +1,122 @@
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+# Measures read latency while a writer commits listening history batches the way the poll worker does, with SQLite's
+# default settings and with the SQLITE_* pragmas from the config. Each mode runs in a fresh process against its own
+# temporary database, so it never touches the real one.
+
+USERS = 20
+SONGS_PER_USER = 2000
+# one reader per spare CPU, so the measurements show lock waits rather than CPU contention
+READER_PROCESSES = max((os.cpu_count() or 2) - 1, 1)
+WRITE_BATCH_SIZE = 500
+DURATION_SECONDS = 10
+
+
+def run_benchmark() -> None:
+    from sqlalchemy.exc import OperationalError
+
+    from server import app, db
+    from server.database.datamanager import get_user_listening_history_page, save_listening_history_batch, save_tracks
+
+    suids = [f'benchmark-user-{i}' for i in range(USERS)]
+    next_played_at = [datetime(2020, 1, 1)]
+    played_at_lock = threading.Lock()
+
+    def build_records(count: int) -> list[dict]:
+        with played_at_lock:
+            start = next_played_at[0]
+            next_played_at[0] += timedelta(seconds=count)
+        return [{
+            'spotify_user_id': suids[i % USERS],
+            'song_id': f'benchmark-song-{i % 100}',
+            'played_at': start + timedelta(seconds=i)
+        } for i in range(count)]
+
+    with app.app_context():
+        db.create_all()
+        save_tracks([{'id': f'benchmark-song-{i}', 'name': '', 'artist_name': '', 'art_link': ''} for i in range(100)])
+        for _ in range(USERS * SONGS_PER_USER // WRITE_BATCH_SIZE):
+            save_listening_history_batch(build_records(WRITE_BATCH_SIZE))
+
+    def write_loop(stop_at: float, results):
+        latencies, errors = [], []
+        with app.app_context():
+            while time.time() < stop_at:
+                start = time.perf_counter()
+                try:
+                    save_listening_history_batch(build_records(WRITE_BATCH_SIZE))
+                except OperationalError as e:
+                    db.session.rollback()
+                    errors.append(f'write: {e.orig}')
+                latencies.append(time.perf_counter() - start)
+        results.put(('write', latencies, errors))
+
+    def read_loop(stop_at: float, results, reader: int):
+        latencies, errors = [], []
+        with app.app_context():
+            i = reader
+            while time.time() < stop_at:
+                start = time.perf_counter()
+                try:
+                    get_user_listening_history_page(suids[i % USERS], 50)
+                    # end the read transaction, like the end of a request does
+                    db.session.rollback()
+                except OperationalError as e:
+                    db.session.rollback()
+                    errors.append(f'read: {e.orig}')
+                latencies.append(time.perf_counter() - start)
+                i += 1
+        results.put(('read', latencies, errors))
+
+    # the poll worker and web server are separate processes, so run the writer and readers in their own processes
+    with app.app_context():
+        db.engine.dispose()
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    stop_at = time.time() + DURATION_SECONDS
+    processes = [context.Process(target=write_loop, args=(stop_at, results))] + \
+                [context.Process(target=read_loop, args=(stop_at, results, i)) for i in range(READER_PROCESSES)]
+    for process in processes:
+        process.start()
+    read_latencies, write_latencies, errors = [], [], []
+    for _ in processes:
+        kind, latencies, process_errors = results.get()
+        (write_latencies if kind == 'write' else read_latencies).extend(latencies)
+        errors.extend(process_errors)
+    for process in processes:
+        process.join()
+
+    def percentile_ms(latencies: list[float], fraction: float) -> float:
+        return sorted(latencies)[min(int(len(latencies) * fraction), len(latencies) - 1)] * 1000
+
+    with app.app_context():
+        print(f'journal mode: {db.session.connection().exec_driver_sql("PRAGMA journal_mode").scalar()}')
+    print(f'writes: {len(write_latencies) / DURATION_SECONDS:.1f} batches/s, '
+          f'p50 {percentile_ms(write_latencies, 0.5):.1f}ms, p99 {percentile_ms(write_latencies, 0.99):.1f}ms')
+    print(f'reads: {len(read_latencies) / DURATION_SECONDS:.1f}/s, p50 {percentile_ms(read_latencies, 0.5):.1f}ms, '
+          f'p99 {percentile_ms(read_latencies, 0.99):.1f}ms, max {percentile_ms(read_latencies, 1):.1f}ms')
+    print(f'errors: {len(errors)}{" (" + errors[0] + ")" if errors else ""}')
+
+
+if __name__ == '__main__':
+    if 'BENCHMARK_MODE' in os.environ:
+        run_benchmark()
+        exit()
+
+    with tempfile.TemporaryDirectory() as directory:
+        for mode, pragmas_enabled in [('SQLite defaults', 'false'), ('configured pragmas', 'true')]:
+            print(f'--- {mode}')
+            subprocess.run([sys.executable, __file__], check=True, env={
+                **os.environ,
+                'BENCHMARK_MODE': mode,
+                'DATABASE_URL': f'sqlite:///{os.path.join(directory, f"benchmark-{pragmas_enabled}.db")}',
+                'SQLITE_PRAGMAS_ENABLED': pragmas_enabled,
+                'RESPONSE_CACHE_ENABLED': 'false',
+            })
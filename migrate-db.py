@@ -0,0 +1,84 @@
+import os
+import sys
+import tempfile
+
+# Upgrades the database at DATABASE_URL to the current models. With --check, a temporary SQLite database with the
+# original schema is upgraded instead, from before song details moved to the track table, and the upgraded data is
+# checked. The real database is never touched by the check.
+
+CHECK = '--check' in sys.argv
+if CHECK:
+    check_directory = tempfile.TemporaryDirectory()
+    os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(check_directory.name, "migrate-check.db")}'
+
+from sqlalchemy import inspect, text
+
+from server import app, db
+from server.database.migrations import upgrade_database
+from server.models import ArtistListeningStats, DailyListeningStats, SongHistoryRecord, SpotifyToken, Track
+
+# the tables as they were before any migration, plus indexes that were added and later dropped
+ORIGINAL_SCHEMA = [
+    'CREATE TABLE spotify_token (id INTEGER PRIMARY KEY, spotify_user_id VARCHAR NOT NULL UNIQUE, '
+    'access_token VARCHAR NOT NULL, refresh_token VARCHAR NOT NULL)',
+    'CREATE TABLE activity (id INTEGER PRIMARY KEY, spotify_user_id VARCHAR NOT NULL, '
+    'activity_name VARCHAR NOT NULL UNIQUE)',
+    'CREATE TABLE listening_session (id INTEGER PRIMARY KEY, spotify_user_id VARCHAR NOT NULL, start_time DATETIME, '
+    'end_time DATETIME, activity_id INTEGER REFERENCES activity (id))',
+    'CREATE TABLE song_history_record (id INTEGER PRIMARY KEY, spotify_user_id VARCHAR NOT NULL, '
+    'song_id VARCHAR NOT NULL, song_name VARCHAR NOT NULL, artist_name VARCHAR NOT NULL, art_link VARCHAR, '
+    'played_at DATETIME UNIQUE)',
+    'CREATE TABLE activity_playlist (id INTEGER PRIMARY KEY, spotify_user_id VARCHAR NOT NULL, '
+    'spotify_playlist_id VARCHAR NOT NULL, playlist_url VARCHAR NOT NULL, activity_id INTEGER UNIQUE '
+    'REFERENCES activity (id))',
+    'CREATE INDEX ix_listening_session_user_activity ON listening_session (spotify_user_id, activity_id)',
+]
+
+ORIGINAL_DATA = [
+    "INSERT INTO spotify_token (spotify_user_id, access_token, refresh_token) "
+    "VALUES ('migrate-check', 'access', 'refresh')",
+    "INSERT INTO activity (id, spotify_user_id, activity_name) VALUES (1, 'migrate-check', 'Running')",
+    "INSERT INTO listening_session (spotify_user_id, start_time, end_time, activity_id) "
+    "VALUES ('migrate-check', '2024-01-01 10:00:00.000000', '2024-01-01 11:00:00.000000', 1)",
+    "INSERT INTO song_history_record (spotify_user_id, song_id, song_name, artist_name, art_link, played_at) VALUES "
+    "('migrate-check', 'song-1', 'Song 1', 'Artist A', '', '2024-01-01 10:00:00.000000'), "
+    "('migrate-check', 'song-2', 'Song 2', 'Artist B', '', '2024-01-01 10:05:00.000000'), "
+    "('migrate-check', 'song-1', 'Song 1', 'Artist A', '', '2024-01-01 10:10:00.000000')",
+]
+
+
+def check_upgraded_database() -> bool:
+    """
+    Checks the original test data made it through the upgrade
+    @return: Whether every check passed
+    """
+    artist_play_counts = dict(db.session.query(ArtistListeningStats.artist_name, ArtistListeningStats.play_count))
+    checks = [
+        ('song details moved to track', db.session.query(Track.id).count() == 2),
+        ('song detail columns dropped',
+         'song_name' not in {column['name'] for column in inspect(db.engine).get_columns('song_history_record')}),
+        ('songs assigned to sessions', SongHistoryRecord.query.filter_by(session_id=None).count() == 0),
+        ('daily stats filled in', db.session.query(DailyListeningStats.play_count).scalar() == 3),
+        ('artist stats filled in', artist_play_counts == {'Artist A': 2, 'Artist B': 1}),
+        ('stored tokens marked as expired', SpotifyToken.query.filter_by(expires_at=None).count() == 0),
+        ('replaced session index dropped', 'ix_listening_session_user_activity' not in
+         {index['name'] for index in inspect(db.engine).get_indexes('listening_session')}),
+    ]
+    for description, passed in checks:
+        print(f'{"ok  " if passed else "FAIL"} {description}')
+    return all(passed for _, passed in checks)
+
+
+with app.app_context():
+    if CHECK:
+        with db.engine.begin() as connection:
+            for statement in ORIGINAL_SCHEMA + ORIGINAL_DATA:
+                connection.execute(text(statement))
+        upgrade_database()
+        # upgrading again must change nothing
+        upgrade_database()
+        if not check_upgraded_database():
+            exit(1)
+    else:
+        upgrade_database()
+        print('Database upgraded.')
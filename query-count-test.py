@@ -0,0 +1,78 @@
+from contextlib import contextmanager
+
+from flask_jwt_extended import create_access_token
+from sqlalchemy import event
+
+from server import app, db
+from server.database.migrations import upgrade_database
+from server.database.syncstate import record_successful_polls
+from server.models import Activity, ActivityPlaylist
+
+# Checks that the number of queries each endpoint runs doesn't grow with the number of activities, so N+1 lazy loads
+# are caught. Test data is only flushed and is rolled back at the end, so it is safe to run against a real database.
+
+ENDPOINTS = ['/playlists/', '/homepage_info/', '/activities/']
+ACTIVITY_COUNTS = [1, 25]
+
+
+@contextmanager
+def count_queries():
+    """
+    Counts the SQL statements sent to the database inside the block
+    @return: A list that the block's statements are appended to
+    """
+    statements = []
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', on_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', on_execute)
+
+
+def add_test_activities(spotify_user_id: str, count: int) -> None:
+    for i in range(count):
+        activity = Activity(spotify_user_id=spotify_user_id, activity_name=f'{spotify_user_id} activity {i}')
+        db.session.add(activity)
+        db.session.flush()
+        db.session.add(ActivityPlaylist(
+            spotify_user_id=spotify_user_id,
+            spotify_playlist_id=f'{spotify_user_id}-playlist-{i}',
+            playlist_url='',
+            activity_id=activity.id
+        ))
+    db.session.flush()
+
+
+with app.app_context():
+    upgrade_database()
+    # measure the queries that build the responses, not cache lookups
+    app.config['RESPONSE_CACHE_ENABLED'] = False
+    app.config['HISTORY_ARCHIVE_MONTHS_CACHE_SECONDS'] = 0
+    client = app.test_client()
+
+    query_counts = {endpoint: [] for endpoint in ENDPOINTS}
+    for activity_count in ACTIVITY_COUNTS:
+        suid = f'query-count-test-{activity_count}'
+        add_test_activities(suid, activity_count)
+        # keep /homepage_info/ from fetching history from Spotify
+        record_successful_polls([suid], commit=False)
+        headers = {'Authorization': f'Bearer {create_access_token(identity=suid)}'}
+        for endpoint in ENDPOINTS:
+            with count_queries() as statements:
+                response = client.get(endpoint, headers=headers)
+            assert response.status_code == 200, f'{endpoint} returned {response.status_code}'
+            query_counts[endpoint].append(len(statements))
+    db.session.rollback()
+
+    failed = False
+    for endpoint, counts in query_counts.items():
+        flat = len(set(counts)) == 1
+        counts_text = ', '.join(f'{n} activities: {c} queries' for n, c in zip(ACTIVITY_COUNTS, counts))
+        print(f'{"ok  " if flat else "FAIL"} {endpoint}: {counts_text}')
+        failed = failed or not flat
+    if failed:
+        exit(1)
@@ -0,0 +1,63 @@
+from datetime import datetime
+
+from sqlalchemy import select
+
+from server import app, db
+from server.database.migrations import upgrade_database
+from server.models import SongHistoryRecord, ListeningSession, Activity
+
+# Checks that the per-user queries are served by an index instead of scanning the whole table.
+# Only reads the query plans, so it is safe to run against a database with real data.
+
+with app.app_context():
+    upgrade_database()
+
+    suid = 'shmexysmusic'
+    queries = {
+        'listening history': SongHistoryRecord.query.filter(SongHistoryRecord.spotify_user_id == suid)
+        .order_by(SongHistoryRecord.played_at.desc()),
+        'listening history after date': SongHistoryRecord.query.filter(SongHistoryRecord.spotify_user_id == suid)
+        .filter(SongHistoryRecord.played_at > datetime.now()).order_by(SongHistoryRecord.played_at.desc()),
+        'latest history record': SongHistoryRecord.query.filter(SongHistoryRecord.spotify_user_id == suid)
+        .order_by(SongHistoryRecord.played_at.desc()).limit(1),
+        'songs for listening sessions': SongHistoryRecord.query.filter(SongHistoryRecord.session_id.in_([1, 2]))
+        .order_by(SongHistoryRecord.played_at),
+        'songs for activity': select(SongHistoryRecord.song_id).where(SongHistoryRecord.session_id.in_(
+            select(ListeningSession.id).where(ListeningSession.activity_id == 1)
+        )).order_by(SongHistoryRecord.played_at),
+        'latest listening session': ListeningSession.query.filter_by(spotify_user_id=suid)
+        .order_by(ListeningSession.end_time.desc()).limit(1),
+        'listening sessions for activity': ListeningSession.query.filter_by(spotify_user_id=suid, activity_id=1)
+        .order_by(ListeningSession.end_time.desc(), ListeningSession.id.desc()),
+        'unlabeled listening sessions page': ListeningSession.query.filter_by(spotify_user_id=suid, activity_id=None)
+        .filter(ListeningSession.end_time < datetime.now()).filter(ListeningSession.end_time >= datetime.now())
+        .order_by(ListeningSession.end_time.desc(), ListeningSession.id.desc()).limit(50),
+        'user activities': Activity.query.filter(Activity.spotify_user_id == suid),
+    }
+
+    # queries that must be served by one specific index. Songs looked up by session are only a few sessions' worth, so
+    # sorting them after the lookup is fine
+    required_indexes = {
+        'songs for listening sessions': 'ix_song_history_record_session_id',
+        'songs for activity': 'ix_song_history_record_session_id',
+    }
+
+    failed = False
+    for name, query in queries.items():
+        statement = query.statement if hasattr(query, 'statement') else query
+        compiled = statement.compile(db.engine, compile_kwargs={'render_postcompile': True})
+        plan = db.session.connection().exec_driver_sql(
+            'EXPLAIN QUERY PLAN ' + str(compiled),
+            (None,) * len(compiled.positiontup)
+        ).all()
+        details = [row[-1] for row in plan]
+        if name in required_indexes:
+            passed = any(f'INDEX {required_indexes[name]} ' in d for d in details)
+        else:
+            uses_index = any('USING INDEX' in d or 'USING COVERING INDEX' in d for d in details)
+            uses_temp_sort = any('USE TEMP B-TREE FOR ORDER BY' in d for d in details)
+            passed = uses_index and not uses_temp_sort
+        print(f'{"ok  " if passed else "FAIL"} {name}: {"; ".join(details)}')
+        failed = failed or not passed
+    if failed:
+        exit(1)
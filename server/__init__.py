@@ -12,4 +12,6 @@ app.config.from_pyfile('config.py')
 
 db.init_app(app)
 
+import server.database.sqlitepragmas
 import server.views
+import server.commands
@@ -0,0 +1,76 @@
+import io
+
+from a2wsgi import WSGIMiddleware
+from a2wsgi.wsgi import build_environ
+from werkzeug.exceptions import HTTPException
+from werkzeug.wrappers import Response
+
+from server import app
+from server.asyncviews import ASYNC_URL_MAP
+
+# Serves the app over ASGI, e.g. `uvicorn server.asgi:asgi_app`. Requests for the async views in server/asyncviews.py
+# are handled on the server's event loop. Every other request is passed to the Flask app, which runs in a pool of
+# ASGI_THREADS threads.
+
+flask_asgi_app = WSGIMiddleware(app, workers=app.config.get('ASGI_THREADS'))
+async_url_adapter = ASYNC_URL_MAP.bind('localhost')
+
+
+async def read_body(receive) -> bytes:
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+async def send_response(send, response: Response) -> None:
+    headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in response.headers.items()]
+    await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': response.get_data()})
+
+
+async def dispatch_async_view(view, view_args: dict) -> Response:
+    """
+    Runs an async view the same way Flask runs a sync view. `before_request` functions run first, exceptions go to the
+    app's error handlers, and the response is made with `after_request` functions applied. Must be called inside a
+    request context
+    """
+    try:
+        try:
+            rv = app.preprocess_request()
+            if rv is None:
+                rv = await view(**view_args)
+        except Exception as e:
+            rv = app.handle_user_exception(e)
+        return app.finalize_request(rv)
+    except Exception as e:
+        return app.handle_exception(e)
+
+
+async def asgi_app(scope, receive, send):
+    if scope['type'] != 'http':
+        await flask_asgi_app(scope, receive, send)
+        return
+    try:
+        view, view_args = async_url_adapter.match(scope['path'], scope['method'])
+    except HTTPException:
+        # not one of the async views, including redirects to add a trailing slash
+        await flask_asgi_app(scope, receive, send)
+        return
+
+    # the request context belongs to this request's task, so it stays pushed while the view awaits
+    environ = build_environ(scope, io.BytesIO(await read_body(receive)))
+    ctx = app.request_context(environ)
+    error = None
+    ctx.push()
+    try:
+        response = await dispatch_async_view(view, view_args)
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        ctx.pop(error)
+    await send_response(send, response)
@@ -0,0 +1,72 @@
+from functools import wraps
+
+from flask import request
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+from werkzeug.routing import Map, Rule
+
+from server import app
+from . import endpoints
+from .database.playlistmanager import create_playlist_async
+from .database.playlistqueue import enqueue_playlist_sync
+from .utils.asynccontext import run_in_app_context
+from .utils.asyncspotifyapiutil import make_authorized_request_async, spotify_request_async
+from .views import get_callback_auth_headers, check_token_response, finish_login
+
+# Async versions of the views that wait on Spotify, served by server/asgi.py at the same urls as the sync views. They
+# run as coroutines on the ASGI server's event loop, inside a Flask request context, so a request waiting on Spotify
+# doesn't hold a thread. Their database work runs in worker threads through `run_in_app_context`.
+
+
+def jwt_required_async(view):
+    """
+    `jwt_required()` for async views. Checking the token doesn't block, so it runs on the event loop
+    """
+    @wraps(view)
+    async def wrapper(*args, **kwargs):
+        verify_jwt_in_request()
+        return await view(*args, **kwargs)
+    return wrapper
+
+
+async def callback():
+    """
+    Async version of views.callback
+    """
+    res = await spotify_request_async('POST', endpoints.TOKEN_URL,
+                                      auth=(app.config.get('CLIENT_ID'), app.config.get('CLIENT_SECRET')),
+                                      data=get_callback_auth_headers(request.args.get('code')))
+    res_data = res.json()
+    check_token_response(res.status_code, res_data)
+
+    headers = {'Authorization': f'Bearer {res_data.get("access_token")}'}
+    me_res = await spotify_request_async('GET', endpoints.ME_URL, headers=headers)
+    return await run_in_app_context(finish_login, me_res.json().get('id'), res_data)
+
+
+@jwt_required_async
+async def create_playlist_endpoint(activity_id):
+    """
+    Async version of views.create_playlist_endpoint. Songs are added to the new playlist in the background, see
+    /playlist_sync_status/
+    """
+    spotify_user_id = get_jwt_identity()
+    await create_playlist_async(spotify_user_id, activity_id)
+    await run_in_app_context(enqueue_playlist_sync, activity_id)
+    return {'result': 'success'}
+
+
+@jwt_required_async
+async def user():
+    """
+    Async version of views.user
+    """
+    spotify_user_id = get_jwt_identity()
+
+    return await make_authorized_request_async(spotify_user_id, endpoints.ME_URL)
+
+
+ASYNC_URL_MAP = Map([
+    Rule('/callback/', endpoint=callback, methods=['POST']),
+    Rule('/create_playlist/<activity_id>/', endpoint=create_playlist_endpoint, methods=['POST']),
+    Rule('/user/', endpoint=user, methods=['GET']),
+])
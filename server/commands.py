@@ -0,0 +1,75 @@
+from datetime import timedelta
+
+import click
+
+from server import app
+from server.database.historyarchive import archive_song_history, get_archive_cutoff
+from server.database.statsmanager import rebuild_all_user_stats, rebuild_user_stats
+from server.database.syncstate import get_sync_health_summary
+from server.utils.backgroundtasks import run_poll_worker
+from server.utils.resessionize import resessionize_all_users, resessionize_users
+
+
+@app.cli.command('poll-worker')
+@click.option('--once', is_flag=True, help='Exit once there are no due jobs left instead of waiting for more.')
+def poll_worker_command(once: bool):
+    """
+    Poll users' Spotify listening history in the background
+    """
+    run_poll_worker(once)
+
+
+@app.cli.command('resessionize')
+@click.option('--gap-seconds', type=int, default=lambda: app.config.get('SESSION_GAP_SECONDS'), show_default=True,
+              help='Songs this far apart or more are in different sessions.')
+@click.option('--min-songs', type=int, default=lambda: app.config.get('SESSION_MIN_SONGS'), show_default=True,
+              help='Sessions with fewer songs than this are dropped.')
+@click.option('--batch-size', type=int, default=500, show_default=True, help='Number of users to rebuild at once.')
+@click.option('--user', 'spotify_user_ids', multiple=True, help='Only rebuild sessions for this user. Repeatable.')
+def resessionize_command(gap_seconds: int, min_songs: int, batch_size: int, spotify_user_ids: tuple[str]):
+    """
+    Rebuild listening sessions from the saved listening history, keeping activity labels
+    """
+    if spotify_user_ids:
+        created = resessionize_users(list(spotify_user_ids), gap_seconds, min_songs)
+    else:
+        created = resessionize_all_users(gap_seconds, min_songs, batch_size)
+    click.echo(f'Created {created} listening sessions.')
+
+
+@app.cli.command('archive-history')
+@click.option('--hot-months', type=int, default=lambda: app.config.get('HISTORY_HOT_MONTHS'), show_default=True,
+              help='Number of months, including the current one, to keep in the main listening history table.')
+def archive_history_command(hot_months: int):
+    """
+    Move listening history from before the last few months into per-month archive tables
+    """
+    archived = archive_song_history(get_archive_cutoff(hot_months))
+    click.echo(f'Archived {archived} songs.')
+
+
+@app.cli.command('rebuild-stats')
+@click.option('--user', 'spotify_user_ids', multiple=True, help='Only rebuild stats for this user. Repeatable.')
+def rebuild_stats_command(spotify_user_ids: tuple[str]):
+    """
+    Recompute listening stats from the saved listening history
+    """
+    if spotify_user_ids:
+        rebuild_user_stats(list(spotify_user_ids))
+    else:
+        rebuild_all_user_stats()
+    click.echo('Rebuilt listening stats.')
+
+
+@app.cli.command('sync-status')
+@click.option('--stale-minutes', type=int, default=lambda: app.config.get('POLL_MAX_INTERVAL_MINUTES') * 2,
+              show_default=True, help='Users not synced for this long are reported as stale.')
+def sync_status_command(stale_minutes: int):
+    """
+    Report how up to date users' listening history is
+    """
+    summary = get_sync_health_summary(timedelta(minutes=stale_minutes))
+    click.echo(f'{summary["users"]} users, {summary["never_synced"]} never synced, {summary["stale"]} stale, '
+               f'{summary["failing"]} failing')
+    for spotify_user_id in summary['failing_users']:
+        click.echo(f'failing: {spotify_user_id}')
@@ -1,26 +1,178 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+from typing import Iterator, Iterable
 
-from server import db
-from server.models import SongHistoryRecord, Activity, ListeningSession, ActivityPlaylist
+from sqlalchemy import insert, select, update, func
+from sqlalchemy.dialects import sqlite, postgresql
+from sqlalchemy.orm import joinedload
+
+from server import db, app
+from server.models import SongHistoryRecord, Activity, ListeningSession, ActivityPlaylist, Track, UserSyncState
+from server.database.historyarchive import get_archive_tables, get_history_tables, to_song_history_records
+from server.database.sessionhooks import get_transaction_info, run_after_commit
+from server.database.statsmanager import add_plays_to_stats, move_session_activity_stats, delete_activity_stats, \
+    upsert_adding
+from server.utils.lrucache import LRUCache
+from server.utils.responsecache import invalidate_user_cache
+
+
+# details of recently used songs, shared by ingestion and serialization. song id -> dict of Track columns
+track_cache = LRUCache(app.config.get('TRACK_CACHE_SIZE'))
+
+# max number of rows sent in a single multi-row INSERT, to stay under the database's bound parameter limit
+INSERT_BATCH_SIZE = 500
+
+
+def insert_ignoring_conflicts(model: type[db.Model]):
+    """
+    Builds an INSERT statement for a model that skips rows violating a unique constraint instead of failing
+    @param model: The model class to insert into
+    @return: The insert statement
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        return sqlite.insert(model).on_conflict_do_nothing()
+    if dialect == 'postgresql':
+        return postgresql.insert(model).on_conflict_do_nothing()
+    # MySQL and MariaDB
+    return insert(model).prefix_with('IGNORE')
+
+
+def save_listening_history_batch(records: list[dict], commit: bool = True) -> int:
+    """
+    Saves many listening history records using multi-row INSERTs. Records whose played_at is already saved are skipped.
+    The saved records are added to the users' listening stats, and their ingest watermarks move up in the same
+    transaction.
+    @param records: dicts with a key for each SongHistoryRecord column. The songs' Tracks must already be saved
+    @param commit: Whether to commit once the records are inserted. Pass `False` to commit several batches together
+    @return: The number of records actually inserted
+    """
+    inserted_records = []
+    for i in range(0, len(records), INSERT_BATCH_SIZE):
+        inserted_records += insert_new_history_records(records[i:i + INSERT_BATCH_SIZE])
+    if inserted_records:
+        tracks = get_tracks(record['song_id'] for record in inserted_records)
+        add_plays_to_stats(inserted_records, {song_id: track['artist_name'] for song_id, track in tracks.items()})
+        advance_ingest_watermarks(inserted_records)
+    if commit:
+        db.session.commit()
+    if inserted_records:
+        for spotify_user_id in {record['spotify_user_id'] for record in inserted_records}:
+            invalidate_user_cache(spotify_user_id, 'history')
+    return len(inserted_records)
+
+
+def advance_ingest_watermarks(records: list[dict]) -> None:
+    """
+    Moves each user's UserSyncState.latest_played_at up to their newest saved record. Doesn't commit
+    @param records: Newly saved listening history records
+    """
+    latest_played_at = {}
+    for record in records:
+        suid = record['spotify_user_id']
+        latest_played_at[suid] = max(latest_played_at.get(suid, record['played_at']), record['played_at'])
+    upsert_adding(UserSyncState, [
+        {'spotify_user_id': suid, 'latest_played_at': played_at, 'open_session_song_count': 0}
+        for suid, played_at in latest_played_at.items()
+    ], ['spotify_user_id'], [], ['latest_played_at'])
+
+
+def insert_new_history_records(records: list[dict]) -> list[dict]:
+    """
+    Inserts listening history records with a single INSERT, skipping the ones whose played_at is already saved.
+    played_at is unique across all users, so a record is also skipped when another user's record has the same played_at
+    @param records: dicts with a key for each SongHistoryRecord column
+    @return: The records that were inserted
+    """
+    statement = insert_ignoring_conflicts(SongHistoryRecord).values(records)
+    if db.session.get_bind().dialect.insert_returning:
+        inserted_keys = {tuple(row) for row in db.session.execute(
+            statement.returning(SongHistoryRecord.spotify_user_id, SongHistoryRecord.played_at)
+        )}
+    else:
+        # without RETURNING, check which records are already saved first. Rows are inserted in order, so of several
+        # records with the same played_at only the first one is inserted
+        taken_played_at = set(db.session.scalars(
+            select(SongHistoryRecord.played_at)
+            .where(SongHistoryRecord.played_at.in_([record['played_at'] for record in records]))
+        ))
+        db.session.execute(statement)
+        inserted_keys = set()
+        for record in records:
+            if record['played_at'] not in taken_played_at:
+                taken_played_at.add(record['played_at'])
+                inserted_keys.add((record['spotify_user_id'], record['played_at']))
+
+    inserted_records = []
+    for record in records:
+        key = (record['spotify_user_id'], record['played_at'])
+        # a record sent twice was only inserted once
+        if key in inserted_keys:
+            inserted_keys.remove(key)
+            inserted_records.append(record)
+    return inserted_records
+
+
+def save_tracks(tracks: list[dict], commit: bool = True) -> None:
+    """
+    Saves the details of songs, skipping songs that are already saved. Songs found in the track cache are assumed to
+    be saved already and aren't sent to the database at all. The saved songs are only added to the cache once the
+    transaction commits, so a rollback can't leave songs in the cache that aren't in the database.
+    @param tracks: dicts with a key for each Track column
+    @param commit: Whether to commit once the tracks are inserted
+    """
+    new_tracks = list({track['id']: track for track in tracks if track['id'] not in track_cache}.values())
+    for i in range(0, len(new_tracks), INSERT_BATCH_SIZE):
+        db.session.execute(insert_ignoring_conflicts(Track).values(new_tracks[i:i + INSERT_BATCH_SIZE]))
+    get_transaction_info().setdefault('uncommitted_track_ids', set()).update(track['id'] for track in new_tracks)
+
+    def cache_new_tracks():
+        for track in new_tracks:
+            track_cache.put(track['id'], track)
+    run_after_commit(cache_new_tracks)
+    if commit:
+        db.session.commit()
+
+
+def get_tracks(song_ids: Iterable[str]) -> dict[str, dict]:
+    """
+    Gets the details of songs, from the track cache if possible. All the songs missing from the cache are loaded with
+    a single query.
+    @param song_ids: ids of the songs
+    @return: dict of song id -> dict with a key for each Track column
+    """
+    tracks = {}
+    missing_ids = set()
+    for song_id in song_ids:
+        track = track_cache.get(song_id)
+        if track is None:
+            missing_ids.add(song_id)
+        else:
+            tracks[song_id] = track
+    if missing_ids:
+        # songs saved earlier in this transaction are cached by `save_tracks` once it commits
+        uncommitted_ids = get_transaction_info().get('uncommitted_track_ids', ())
+        for track in db.session.execute(select(Track.id, Track.name, Track.artist_name, Track.art_link)
+                                        .where(Track.id.in_(missing_ids))).mappings():
+            tracks[track['id']] = dict(track)
+            if track['id'] not in uncommitted_ids:
+                track_cache.put(track['id'], tracks[track['id']])
+    return tracks
 
 
 def save_to_listening_history(spotify_user_id: str, song_id: str, song_name: str, artist_name: str, art_link: str,
                               played_at: datetime) -> None:
-    lh = SongHistoryRecord(
-        spotify_user_id=spotify_user_id,
-        song_id=song_id,
-        song_name=song_name,
-        artist_name=artist_name,
-        art_link=art_link,
-        played_at=played_at
-    )
-    db.session.add(lh)
-    db.session.commit()
+    save_tracks([{'id': song_id, 'name': song_name, 'artist_name': artist_name, 'art_link': art_link}], commit=False)
+    save_listening_history_batch([{
+        'spotify_user_id': spotify_user_id,
+        'song_id': song_id,
+        'played_at': played_at
+    }])
 
 
 def get_user_listening_history(spotify_user_id: str, limit: int = None) -> list[SongHistoryRecord]:
     """
-    Get the saved listening history for a user
+    Get the saved listening history for a user. Archived history is only read if the hot table has fewer than `limit`
+    songs
     @param spotify_user_id: The user to get history for
     @param limit: The max number of entries to return (newest first)
     @return: The list of SongHistoryRecord objects
@@ -31,9 +183,128 @@ def get_user_listening_history(spotify_user_id: str, limit: int = None) -> list[
     else:
         result = SongHistoryRecord.query.filter(SongHistoryRecord.spotify_user_id == spotify_user_id) \
             .order_by(SongHistoryRecord.played_at.desc()).all()
+    for archive_table in get_archive_tables():
+        if limit and len(result) >= limit:
+            break
+        statement = select(archive_table) \
+            .where(archive_table.c.spotify_user_id == spotify_user_id) \
+            .order_by(archive_table.c.played_at.desc())
+        if limit:
+            statement = statement.limit(limit - len(result))
+        result += to_song_history_records(db.session.execute(statement))
     return result
 
 
+def get_user_listening_history_page(spotify_user_id: str, limit: int,
+                                    before: tuple[datetime, int] = None) -> list[SongHistoryRecord]:
+    """
+    Get one page of the saved listening history for a user, newest first, using keyset pagination on (played_at, id).
+    Archived history is only read once the page runs past the hot table.
+    @param spotify_user_id: The user to get history for
+    @param limit: The max number of entries to return
+    @param before: (played_at, id) of the last record on the previous page, or None for the first page
+    @return: The list of SongHistoryRecord objects
+    """
+    def is_before(columns):
+        before_played_at, before_id = before
+        return (columns.played_at < before_played_at) | \
+            ((columns.played_at == before_played_at) & (columns.id < before_id))
+
+    query = SongHistoryRecord.query.filter(SongHistoryRecord.spotify_user_id == spotify_user_id)
+    if before:
+        query = query.filter(is_before(SongHistoryRecord))
+    result = query.order_by(SongHistoryRecord.played_at.desc(), SongHistoryRecord.id.desc()).limit(limit).all()
+    for archive_table in get_archive_tables(end=before[0] if before else None):
+        if len(result) >= limit:
+            break
+        statement = select(archive_table).where(archive_table.c.spotify_user_id == spotify_user_id)
+        if before:
+            statement = statement.where(is_before(archive_table.c))
+        result += to_song_history_records(db.session.execute(
+            statement.order_by(archive_table.c.played_at.desc(), archive_table.c.id.desc()).limit(limit - len(result))
+        ))
+    return result
+
+
+def encode_history_cursor(listening_history_record: SongHistoryRecord) -> str:
+    """
+    Creates a pagination cursor pointing at a SongHistoryRecord, for use with `get_user_listening_history_page`
+    @param listening_history_record: The last record on a page
+    @return: The cursor, as an opaque string for the client to send back
+    """
+    return encode_cursor(listening_history_record.played_at, listening_history_record.id)
+
+
+def decode_history_cursor(cursor: str) -> tuple[datetime, int]:
+    """
+    Reads a pagination cursor created by `encode_history_cursor`
+    @param cursor: The cursor string
+    @return: (played_at, id) of the record the cursor points at
+    @raise ValueError: If the cursor is malformed
+    """
+    return decode_cursor(cursor)
+
+
+def encode_cursor(timestamp: datetime, row_id: int) -> str:
+    """
+    Creates an opaque keyset pagination cursor from the sort columns of the last row on a page
+    """
+    timestamp_micros = (timestamp - datetime.utcfromtimestamp(0)) // timedelta(microseconds=1)
+    return f'{timestamp_micros}_{row_id}'
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    """
+    Reads a cursor created by `encode_cursor`
+    @raise ValueError: If the cursor is malformed
+    """
+    timestamp_micros, row_id = cursor.split('_')
+    return datetime.utcfromtimestamp(0) + timedelta(microseconds=int(timestamp_micros)), int(row_id)
+
+
+def iter_user_listening_history(spotify_user_id: str, batch_size: int = 500) -> Iterator[SongHistoryRecord]:
+    """
+    Iterate over all the saved listening history for a user, newest first, including archived history. Rows are
+    fetched from the database `batch_size` at a time, so memory use doesn't grow with the length of the history.
+    @param spotify_user_id: The user to get history for
+    @param batch_size: How many rows to load into memory at once
+    @return: A generator of SongHistoryRecord objects
+    """
+    statement = select(SongHistoryRecord) \
+        .filter(SongHistoryRecord.spotify_user_id == spotify_user_id) \
+        .order_by(SongHistoryRecord.played_at.desc(), SongHistoryRecord.id.desc()) \
+        .execution_options(yield_per=batch_size)
+    yield from db.session.scalars(statement)
+    for archive_table in get_archive_tables():
+        statement = select(archive_table) \
+            .where(archive_table.c.spotify_user_id == spotify_user_id) \
+            .order_by(archive_table.c.played_at.desc(), archive_table.c.id.desc()) \
+            .execution_options(yield_per=batch_size)
+        for partition in db.session.execute(statement).partitions():
+            yield from to_song_history_records(partition)
+
+
+def iter_user_played_at_after(spotify_user_id: str, after: datetime = None,
+                              batch_size: int = 500) -> Iterator[datetime]:
+    """
+    Iterate over the played_at times of a user's saved listening history, oldest first. Rows are fetched from the
+    database `batch_size` at a time. Archived history is only read if `after` is in an archived month.
+    @param spotify_user_id: The user to get history for
+    @param after: Only songs played after this time are returned. If None, the whole history is returned
+    @param batch_size: How many rows to load into memory at once
+    @return: A generator of played_at datetimes
+    """
+    tables = get_archive_tables(start=after, newest_first=False) + [SongHistoryRecord.__table__]
+    for table in tables:
+        statement = select(table.c.played_at) \
+            .where(table.c.spotify_user_id == spotify_user_id) \
+            .order_by(table.c.played_at) \
+            .execution_options(yield_per=batch_size)
+        if after is not None:
+            statement = statement.where(table.c.played_at > after)
+        yield from db.session.scalars(statement)
+
+
 def get_user_listening_history_after_date(spotify_user_id: str, after: datetime) -> list[SongHistoryRecord]:
     """
     Get the saved listening history for a user
@@ -45,31 +316,53 @@ def get_user_listening_history_after_date(spotify_user_id: str, after: datetime)
         .filter(SongHistoryRecord.spotify_user_id == spotify_user_id)\
         .filter(SongHistoryRecord.played_at > after) \
         .order_by(SongHistoryRecord.played_at.desc()).all()
+    for archive_table in get_archive_tables(start=after):
+        result += to_song_history_records(db.session.execute(
+            select(archive_table)
+            .where(archive_table.c.spotify_user_id == spotify_user_id)
+            .where(archive_table.c.played_at > after)
+            .order_by(archive_table.c.played_at.desc())
+        ))
     return result
 
 
-def listening_history_to_dict(listening_history_record: SongHistoryRecord) -> dict:
+def listening_history_to_dict(listening_history_record: SongHistoryRecord, track: dict = None) -> dict:
     """
     Converts a SongHistoryRecord object to a dictionary
     @param listening_history_record: The SongHistoryRecord database object
+    @param track: The details of the record's song, as returned by `get_tracks`. Looked up if not given. If the song
+    isn't saved, its details are None
     @return: A dictionary containing a key for each attribute
     """
+    if track is None:
+        track = get_tracks([listening_history_record.song_id]).get(listening_history_record.song_id, {})
     played_at_milliseconds = datetime_to_epoch(listening_history_record.played_at)
     return {
         'spotify_user_id': listening_history_record.spotify_user_id,
         'song_id': listening_history_record.song_id,
-        'song_name': listening_history_record.song_name,
-        'artist_name': listening_history_record.artist_name,
-        'art_link': listening_history_record.art_link,
+        'song_name': track.get('name'),
+        'artist_name': track.get('artist_name'),
+        'art_link': track.get('art_link'),
         'played_at_millis': played_at_milliseconds
     }
 
 
+def listening_history_to_dicts(listening_history_records: list[SongHistoryRecord]) -> list[dict]:
+    """
+    Converts many SongHistoryRecord objects to dictionaries, looking up all of their songs at once
+    @param listening_history_records: The SongHistoryRecord database objects
+    @return: A list of dictionaries, see `listening_history_to_dict`
+    """
+    tracks = get_tracks(lh.song_id for lh in listening_history_records)
+    return [listening_history_to_dict(lh, tracks.get(lh.song_id, {})) for lh in listening_history_records]
+
+
 def save_listening_session(
     spotify_user_id: str,
     start_time: datetime,
     end_time: datetime,
-    activity_id: int = None
+    activity_id: int = None,
+    commit: bool = True
 ) -> ListeningSession:
     ls = ListeningSession(
         spotify_user_id=spotify_user_id,
@@ -78,13 +371,50 @@ def save_listening_session(
         activity_id=activity_id
     )
     db.session.add(ls)
-    db.session.commit()
+    db.session.flush()
+    assign_songs_to_listening_session(ls)
+    if commit:
+        db.session.commit()
+    invalidate_user_cache(spotify_user_id, 'sessions')
     return ls
 
 
+def assign_songs_to_listening_session(ls: ListeningSession) -> None:
+    """
+    Links the songs played during a listening session to it, by setting their session_id
+    @param ls: The ListeningSession. Must already have an id
+    """
+    for table in get_history_tables(ls.start_time, ls.end_time):
+        db.session.execute(
+            update(table)
+            .where(table.c.spotify_user_id == ls.spotify_user_id)
+            .where(table.c.played_at >= ls.start_time)
+            .where(table.c.played_at <= ls.end_time)
+            .values(session_id=ls.id)
+        )
+
+
+def assign_all_songs_to_listening_sessions() -> None:
+    """
+    Sets the session_id of every song in the listening history from the listening sessions' time ranges, in a single
+    statement. Used to fill in session_id for history saved before it existed.
+    """
+    matching_session_id = select(ListeningSession.id) \
+        .where(ListeningSession.spotify_user_id == SongHistoryRecord.spotify_user_id) \
+        .where(SongHistoryRecord.played_at >= ListeningSession.start_time) \
+        .where(SongHistoryRecord.played_at <= ListeningSession.end_time) \
+        .limit(1) \
+        .scalar_subquery()
+    db.session.execute(update(SongHistoryRecord).values(session_id=matching_session_id))
+    db.session.commit()
+
+
 def set_listening_session_activity(listening_session: ListeningSession, activity: Activity) -> None:
+    spotify_user_id = listening_session.spotify_user_id
+    move_session_activity_stats(listening_session, listening_session.activity_id, activity.id)
     listening_session.activity_id = activity.id
     db.session.commit()
+    invalidate_user_cache(spotify_user_id, 'sessions')
 
 
 def set_listening_session_activity_by_id(listening_session_id: int, activity_id: int):
@@ -103,35 +433,132 @@ def get_latest_listening_session(spotify_user_id: str) -> ListeningSession:
         .order_by(ListeningSession.end_time.desc()).first()
 
 
-def get_listening_sessions_for_activity(spotify_user_id: str, activity_id: int = None) -> list[ListeningSession]:
+def get_listening_sessions_for_activity(
+    spotify_user_id: str,
+    activity_id: int = None,
+    limit: int = None,
+    before: tuple[datetime, int] = None,
+    window_start: datetime = None,
+    window_end: datetime = None
+) -> list[ListeningSession]:
     """
-    Returns listening sessions for activity, or unlabeled listening sessions if activity_id=None
+    Returns a user's listening sessions for an activity, or their unlabeled listening sessions if activity_id=None.
+    Sessions are newest first, using keyset pagination on (end_time, id).
     @param spotify_user_id: The spotify user to get listening sessions for
     @param activity_id: id of activity, or None
+    @param limit: The max number of sessions to return, or None for all of them
+    @param before: (end_time, id) of the last session on the previous page, or None for the first page
+    @param window_start: Only return sessions that end at or after this time
+    @param window_end: Only return sessions that start at or before this time
     @return: list of ListeningSession objects
     """
-    return ListeningSession.query.filter(ListeningSession.activity_id == activity_id).all()
+    query = ListeningSession.query \
+        .filter(ListeningSession.spotify_user_id == spotify_user_id) \
+        .filter(ListeningSession.activity_id == activity_id)
+    if before:
+        before_end_time, before_id = before
+        query = query.filter(
+            (ListeningSession.end_time < before_end_time) |
+            ((ListeningSession.end_time == before_end_time) & (ListeningSession.id < before_id))
+        )
+    if window_start:
+        query = query.filter(ListeningSession.end_time >= window_start)
+    if window_end:
+        query = query.filter(ListeningSession.start_time <= window_end)
+    query = query.order_by(ListeningSession.end_time.desc(), ListeningSession.id.desc())
+    if limit:
+        query = query.limit(limit)
+    return query.all()
+
+
+def encode_session_cursor(listening_session: ListeningSession) -> str:
+    """
+    Creates a pagination cursor pointing at a ListeningSession, for use with `get_listening_sessions_for_activity`
+    @param listening_session: The last session on a page
+    @return: The cursor, as an opaque string for the client to send back
+    """
+    return encode_cursor(listening_session.end_time, listening_session.id)
+
+
+def decode_session_cursor(cursor: str) -> tuple[datetime, int]:
+    """
+    Reads a pagination cursor created by `encode_session_cursor`
+    @param cursor: The cursor string
+    @return: (end_time, id) of the session the cursor points at
+    @raise ValueError: If the cursor is malformed
+    """
+    return decode_cursor(cursor)
 
 
 def get_songs_for_listening_session(ls: ListeningSession) -> list[SongHistoryRecord]:
-    return SongHistoryRecord.query.filter(
-        (SongHistoryRecord.played_at >= ls.start_time) &
-        (SongHistoryRecord.played_at <= ls.end_time) &
-        (SongHistoryRecord.spotify_user_id == ls.spotify_user_id)
-    ).all()
+    return get_songs_for_listening_sessions([ls.id])
+
+
+def get_songs_for_listening_sessions(listening_session_ids: list[int]) -> list[SongHistoryRecord]:
+    """
+    Get the songs from many listening sessions. Archived history is only read for the months the sessions cover
+    @param listening_session_ids: ids of the ListeningSessions
+    @return: The list of SongHistoryRecord objects, oldest first
+    """
+    result = SongHistoryRecord.query.filter(SongHistoryRecord.session_id.in_(listening_session_ids)) \
+        .order_by(SongHistoryRecord.played_at).all()
+    start_time, end_time = db.session.execute(
+        select(func.min(ListeningSession.start_time), func.max(ListeningSession.end_time))
+        .where(ListeningSession.id.in_(listening_session_ids))
+    ).one()
+    if start_time is None:
+        return result
+    archived = []
+    for archive_table in get_archive_tables(start_time, end_time, newest_first=False):
+        archived += to_song_history_records(db.session.execute(
+            select(archive_table)
+            .where(archive_table.c.session_id.in_(listening_session_ids))
+            .order_by(archive_table.c.played_at)
+        ))
+    # archived songs are older than every song in the hot table
+    return archived + result
+
+
+def get_song_ids_for_activity(activity_id: int) -> list[str]:
+    """
+    Get the ids of every song from every listening session labeled with an activity. Archived history is only read
+    for the months the activity's sessions cover
+    @param activity_id: id of the Activity
+    @return: The song ids, oldest play first. A song appears once for each time it was played
+    """
+    start_time, end_time = db.session.execute(
+        select(func.min(ListeningSession.start_time), func.max(ListeningSession.end_time))
+        .where(ListeningSession.activity_id == activity_id)
+    ).one()
+    if start_time is None:
+        return []
+    # an IN subquery instead of a join, so songs are found through the session_id index instead of a scan of history
+    session_ids = select(ListeningSession.id).where(ListeningSession.activity_id == activity_id)
+    song_ids = []
+    for table in get_archive_tables(start_time, end_time, newest_first=False) + [SongHistoryRecord.__table__]:
+        song_ids += db.session.scalars(
+            select(table.c.song_id)
+            .where(table.c.session_id.in_(session_ids))
+            .order_by(table.c.played_at)
+        )
+    return song_ids
 
 
 def create_activity(spotify_user_id: str, activity_name: str) -> Activity:
     a = Activity(spotify_user_id=spotify_user_id, activity_name=activity_name)
     db.session.add(a)
     db.session.commit()
+    invalidate_user_cache(spotify_user_id, 'activities')
     return a
 
 
 def delete_activity(activity_id: int):
     a = Activity.query.filter_by(id=activity_id).first()
+    spotify_user_id = a.spotify_user_id
+    delete_activity_stats(activity_id)
     db.session.delete(a)
     db.session.commit()
+    invalidate_user_cache(spotify_user_id, 'activities', 'sessions', 'playlists', 'stats')
 
 
 def create_default_activities(spotify_user_id: str) -> None:
@@ -144,12 +571,21 @@ def create_default_activities(spotify_user_id: str) -> None:
         create_activity(spotify_user_id, activity_name)
 
 
-def get_user_activities(spotify_user_id: str, limit: int = None) -> list[Activity]:
+def get_user_activities(spotify_user_id: str, limit: int = None, with_playlists: bool = False) -> list[Activity]:
+    """
+    Get a user's activities
+    @param spotify_user_id: The user to get activities for
+    @param limit: Max number of activities to return
+    @param with_playlists: Whether to load each activity's playlist in the same query. Use this when accessing
+    `activity_playlist` on every activity, which otherwise runs a query per activity
+    @return: The user's activities
+    """
+    query = Activity.query.filter(Activity.spotify_user_id == spotify_user_id)
+    if with_playlists:
+        query = query.options(joinedload(Activity.activity_playlist))
     if limit:
-        result = Activity.query.filter(Activity.spotify_user_id == spotify_user_id).limit(limit).all()
-    else:
-        result = Activity.query.filter(Activity.spotify_user_id == spotify_user_id).all()
-    return result
+        query = query.limit(limit)
+    return query.all()
 
 
 def datetime_to_epoch(date_time: datetime):
@@ -159,3 +595,10 @@ def datetime_to_epoch(date_time: datetime):
     @return:
     """
     return int((date_time - datetime.utcfromtimestamp(0)).total_seconds() * 1000)
+
+
+def epoch_to_datetime(epoch_millis: int) -> datetime:
+    """
+    Converts milliseconds since the epoch to a datetime object, the inverse of `datetime_to_epoch`
+    """
+    return datetime.utcfromtimestamp(0) + timedelta(milliseconds=epoch_millis)
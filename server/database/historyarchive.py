@@ -0,0 +1,152 @@
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import Table, MetaData, Column, Integer, String, DateTime, Index, inspect, select, insert, delete, func
+
+from server import db, app
+from server.models import SongHistoryRecord
+
+# Listening history is split into a hot table, SongHistoryRecord, holding the last HISTORY_HOT_MONTHS months, and one
+# archive table per older month. Months are archived oldest first, a month at a time, so every archived song is older
+# than every song still in the hot table. Queries read the hot table first and only open the archive tables their
+# time range needs.
+
+ARCHIVE_TABLE_PREFIX = 'song_history_archive_'
+
+# archive tables aren't part of db.metadata, so create_all and migrations leave them alone
+archive_metadata = MetaData()
+_archive_metadata_lock = threading.Lock()
+
+# when the archived months were last read from the database, and the months. See `get_archived_months`
+_archived_months_cache: tuple[float, list[datetime]] = None
+
+
+def get_month_start(date_time: datetime) -> datetime:
+    return datetime(date_time.year, date_time.month, 1)
+
+
+def add_months(month: datetime, months: int) -> datetime:
+    month_index = month.year * 12 + month.month - 1 + months
+    return datetime(month_index // 12, month_index % 12 + 1, 1)
+
+
+def get_archive_table(month: datetime) -> Table:
+    """
+    Get the archive table for a month of listening history. It has the same columns as SongHistoryRecord, and may not
+    exist in the database yet
+    @param month: The first day of the month
+    @return: The Table
+    """
+    name = f'{ARCHIVE_TABLE_PREFIX}{month:%Y_%m}'
+    with _archive_metadata_lock:
+        if name in archive_metadata.tables:
+            return archive_metadata.tables[name]
+        return Table(
+            name, archive_metadata,
+            Column('id', Integer, primary_key=True),
+            Column('spotify_user_id', String, nullable=False),
+            Column('song_id', String, nullable=False),
+            Column('played_at', DateTime, unique=True),
+            Column('session_id', Integer, nullable=True, index=True),
+            Index(f'ix_{name}_user_played_at', 'spotify_user_id', 'played_at'),
+        )
+
+
+def get_archive_month(archive_table: Table) -> datetime:
+    """
+    Get the month an archive table holds, as the first day of the month
+    """
+    return datetime.strptime(archive_table.name.removeprefix(ARCHIVE_TABLE_PREFIX), '%Y_%m')
+
+
+def get_archived_months() -> list[datetime]:
+    """
+    Get the months of listening history that have been archived. They're read from the database's catalog at most every
+    HISTORY_ARCHIVE_MONTHS_CACHE_SECONDS, and again right after `archive_song_history` archives a month
+    @return: The first day of each archived month, oldest first
+    """
+    global _archived_months_cache
+    cache = _archived_months_cache
+    if cache is None or time.monotonic() - cache[0] >= app.config.get('HISTORY_ARCHIVE_MONTHS_CACHE_SECONDS'):
+        table_names = inspect(db.session.connection()).get_table_names()
+        cache = (time.monotonic(), sorted(
+            datetime.strptime(name.removeprefix(ARCHIVE_TABLE_PREFIX), '%Y_%m')
+            for name in table_names if name.startswith(ARCHIVE_TABLE_PREFIX)
+        ))
+        _archived_months_cache = cache
+    return list(cache[1])
+
+
+def get_archive_tables(start: datetime = None, end: datetime = None, newest_first: bool = True) -> list[Table]:
+    """
+    Get the archive tables that may hold songs played within a time range
+    @param start: Start of the range, or None for no lower bound
+    @param end: End of the range (inclusive), or None for no upper bound
+    @param newest_first: Whether to order the tables from the newest month to the oldest
+    @return: The archive Tables, in month order
+    """
+    months = [
+        month for month in get_archived_months()
+        if (start is None or add_months(month, 1) > start) and (end is None or month <= end)
+    ]
+    if newest_first:
+        months.reverse()
+    return [get_archive_table(month) for month in months]
+
+
+def get_history_tables(start: datetime = None, end: datetime = None) -> list[Table]:
+    """
+    Get every table that may hold songs played within a time range: the hot table, then the archive tables newest first
+    """
+    return [SongHistoryRecord.__table__] + get_archive_tables(start, end)
+
+
+def to_song_history_records(rows) -> list[SongHistoryRecord]:
+    """
+    Converts rows read from an archive table to SongHistoryRecord objects. The objects aren't part of the session
+    """
+    return [SongHistoryRecord(**row._mapping) for row in rows]
+
+
+def get_archive_cutoff(hot_months: int = None, now: datetime = None) -> datetime:
+    """
+    Get the time before which songs belong in the archive, the start of the oldest month kept in the hot table
+    @param hot_months: Number of months kept in the hot table, including the current one. Defaults to HISTORY_HOT_MONTHS
+    @param now: The current time. Defaults to now
+    """
+    hot_months = hot_months or app.config.get('HISTORY_HOT_MONTHS')
+    now = now or datetime.utcnow()
+    return add_months(get_month_start(now), -hot_months + 1)
+
+
+def archive_song_history(cutoff: datetime = None) -> int:
+    """
+    Moves songs played before the cutoff out of the hot table into their month's archive table. Each month is moved
+    in its own transaction, oldest first.
+    @param cutoff: Songs played before the start of this month are archived. Defaults to `get_archive_cutoff()`
+    @return: The number of songs archived
+    """
+    global _archived_months_cache
+    cutoff = get_month_start(cutoff or get_archive_cutoff())
+    hot_table = SongHistoryRecord.__table__
+    archived = 0
+    # start from the oldest song each time, so months without songs are skipped
+    while oldest_played_at := db.session.scalar(
+        select(func.min(hot_table.c.played_at)).where(hot_table.c.played_at < cutoff)
+    ):
+        month = get_month_start(oldest_played_at)
+        archive_table = get_archive_table(month)
+        archive_table.create(db.session.connection(), checkfirst=True)
+        in_month = (hot_table.c.played_at >= month) & (hot_table.c.played_at < add_months(month, 1))
+        columns = [hot_table.c[column.name] for column in archive_table.columns]
+        db.session.execute(
+            insert(archive_table).from_select([column.name for column in columns], select(*columns).where(in_month))
+        )
+        archived += db.session.execute(delete(hot_table).where(in_month)).rowcount
+        db.session.commit()
+        # the month's table may be new, so read the archived months again
+        _archived_months_cache = None
+    if archived:
+        app.logger.info('Archived %d songs played before %s', archived, cutoff)
+    return archived
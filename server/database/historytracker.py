@@ -1,24 +1,35 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
 from urllib.parse import urlencode
 
+from sqlalchemy.exc import SQLAlchemyError
+
 from server import endpoints, db, app
-from server.models import SpotifyToken, SongHistoryRecord
+from server.database.datamanager import save_listening_history_batch, save_tracks
+from server.database.syncstate import get_ingest_watermark, get_last_polled_at, record_successful_polls, \
+    record_poll_failure
 from server.utils.listeningsession import create_listening_sessions
+from server.utils.ratelimiter import request_priority, BACKGROUND
 from server.utils.spotifyapiutil import make_authorized_request
 
+# users with a refresh queued by the endpoints
+_pending_refreshes: set[str] = set()
+_sync_lock = threading.Lock()
+_refresh_executor = ThreadPoolExecutor(max_workers=app.config.get('HISTORY_REFRESH_WORKERS'))
+
 
 def get_user_recently_played(spotify_user_id: str) -> list[dict]:
     url = endpoints.HISTORY_URL
     # get the played_at time for the most recent history record
-    latest_history_record = \
-        SongHistoryRecord.query.filter(SongHistoryRecord.spotify_user_id == spotify_user_id) \
-        .order_by(SongHistoryRecord.played_at.desc()).limit(1).first()
+    latest_played_at = get_ingest_watermark(spotify_user_id)
 
     # add "after" parameter if there is already listening history for this user
     url_params = {'limit': 50}
 
-    if latest_history_record:
-        latest_history_entry_time: datetime = latest_history_record.played_at.replace(tzinfo=timezone.utc)
+    if latest_played_at:
+        latest_history_entry_time: datetime = latest_played_at.replace(tzinfo=timezone.utc)
         url_params['after'] = int(latest_history_entry_time.timestamp() * 1e3)
 
     url = url + f'/?{urlencode(url_params)}'
@@ -28,33 +39,192 @@ def get_user_recently_played(spotify_user_id: str) -> list[dict]:
     return res.get('items')
 
 
-def save_user_recently_played(spotify_user_id: str) -> None:
+def parse_played_at(played_at: str) -> datetime:
+    """
+    Parses a `played_at` timestamp from Spotify, e.g. '2023-04-01T12:30:00.123Z', into a naive UTC datetime
+    """
+    return datetime.fromisoformat(played_at).replace(tzinfo=None)
+
+
+def build_history_records(spotify_user_id: str, song_history: list[dict]) -> list[dict]:
+    """
+    Converts the items returned by the recently played endpoint into rows for the song history table
+    @param spotify_user_id: The user the items belong to
+    @param song_history: The 'items' array from the Spotify response
+    @return: The list of rows, as dicts with a key for each SongHistoryRecord column
+    """
+    # TODO check that `is_local` == False
+    played_at_dates = [parse_played_at(song['played_at']) for song in song_history]
+    return [{
+        'spotify_user_id': spotify_user_id,
+        'song_id': song['track']['id'],
+        'played_at': played_at
+    } for song, played_at in zip(song_history, played_at_dates)]
+
+
+def build_tracks(song_history: list[dict]) -> list[dict]:
+    """
+    Extracts the details of each song from the items returned by the recently played endpoint
+    @param song_history: The 'items' array from the Spotify response
+    @return: The list of rows for the track table, as dicts with a key for each Track column
+    """
+    return [{
+        'id': song['track']['id'],
+        'name': song['track']['name'],
+        'artist_name': song['track']['artists'][0]['name'],
+        'art_link': song['track']['album']['images'][0]['url'],  # TODO get the smallest sized image
+    } for song in song_history]
+
+
+def save_user_recently_played(spotify_user_id: str) -> int:
+    """
+    Fetches and saves the songs a user has played since their last saved song
+    @param spotify_user_id: The user to fetch history for
+    @return: The number of new songs saved
+    """
     app.logger.info('Fetching listening history for ' + spotify_user_id)
     song_history = get_user_recently_played(spotify_user_id)
-    for song in song_history:
-        # TODO check that `is_local` == False
-        try:
-            played_at_date = datetime.strptime(song['played_at'], '%Y-%m-%dT%H:%M:%S.%fZ')
-        except ValueError:
-            played_at_date = datetime.strptime(song['played_at'], '%Y-%m-%dT%H:%M:%SZ')
-        db.session.add(SongHistoryRecord(
-            spotify_user_id=spotify_user_id,
-            song_id=song['track']['id'],
-            song_name=song['track']['name'],
-            artist_name=song['track']['artists'][0]['name'],
-            art_link=song['track']['album']['images'][0]['url'],  # TODO get the smallest sized image
-            played_at=played_at_date
-        ))
-    db.session.commit()
+    save_tracks(build_tracks(song_history), commit=False)
+    record_successful_polls([spotify_user_id], commit=False)
+    return save_listening_history_batch(build_history_records(spotify_user_id, song_history))
 
 
 def update_user_history(spotify_user_id: str):
-    save_user_recently_played(spotify_user_id)
-    create_listening_sessions(spotify_user_id)
+    try:
+        save_user_recently_played(spotify_user_id)
+        create_listening_sessions(spotify_user_id)
+    except Exception as e:
+        db.session.rollback()
+        record_poll_failure(spotify_user_id, e)
+        raise
+
+
+def is_user_history_fresh(spotify_user_id: str) -> bool:
+    """
+    @return: Whether the user's history was synced within the last `HISTORY_FRESHNESS_SECONDS`, by any process
+    """
+    last_polled_at = get_last_polled_at(spotify_user_id)
+    return last_polled_at is not None and \
+        (datetime.utcnow() - last_polled_at).total_seconds() < app.config.get('HISTORY_FRESHNESS_SECONDS')
+
+
+def refresh_user_history_in_background(spotify_user_id: str) -> None:
+    try:
+        with app.app_context():
+            update_user_history(spotify_user_id)
+    except Exception:
+        app.logger.exception(f'Failed to refresh listening history for {spotify_user_id}')
+    finally:
+        with _sync_lock:
+            _pending_refreshes.discard(spotify_user_id)
+
+
+def request_user_history_refresh(spotify_user_id: str) -> bool:
+    """
+    Queues a background refresh of a user's history, unless it is already fresh or a refresh is already queued
+    @param spotify_user_id: The user to refresh
+    @return: Whether a new refresh was queued
+    """
+    if is_user_history_fresh(spotify_user_id):
+        return False
+    with _sync_lock:
+        if spotify_user_id in _pending_refreshes:
+            return False
+        _pending_refreshes.add(spotify_user_id)
+    _refresh_executor.submit(refresh_user_history_in_background, spotify_user_id)
+    return True
+
+
+def sync_user_history(spotify_user_id: str) -> None:
+    """
+    Brings a user's history up to date before it is read by an endpoint. If `HISTORY_SYNC_MODE` is 'background', this
+    returns immediately and the refresh happens in the background, so the endpoint serves what is already saved.
+    Otherwise, the refresh happens before returning. Either way, nothing is fetched if the history is still fresh.
+    @param spotify_user_id: The user to sync
+    """
+    if app.config.get('HISTORY_SYNC_MODE') == 'background':
+        request_user_history_refresh(spotify_user_id)
+    elif not is_user_history_fresh(spotify_user_id):
+        update_user_history(spotify_user_id)
+
+
+def fetch_user_recently_played(spotify_user_id: str) -> list[dict]:
+    """
+    Fetches a user's recently played songs from a worker thread. Each call gets its own app context, and with it its own
+    database session. Requests are sent in the background priority lane, behind requests from the API endpoints.
+    @param spotify_user_id: The user to fetch history for
+    @return: The 'items' array from the Spotify response
+    """
+    with app.app_context(), request_priority(BACKGROUND):
+        return get_user_recently_played(spotify_user_id)
+
+
+def poll_users(spotify_user_ids: list[str]) -> dict:
+    """
+    Fetches new listening history for many users at once. Spotify requests are spread across a pool of
+    `HISTORY_POLL_WORKERS` threads, then all the new records are written in a single batch from the calling thread.
+    Must be called inside an app context.
+    @param spotify_user_ids: The users to poll
+    @return: Stats for this cycle: number of users polled, number of failures, songs saved, and wall time in seconds.
+    Also includes the number of songs Spotify returned for each user that was polled successfully, under 'new_plays'
+    """
+    start = time.monotonic()
+    failed_users = set()
+    errors: dict[str, Exception] = {}
+    fetched_history: dict[str, list[dict]] = {}
+
+    # fetch phase: network bound, so run concurrently
+    with ThreadPoolExecutor(max_workers=app.config.get('HISTORY_POLL_WORKERS')) as executor:
+        futures = {executor.submit(fetch_user_recently_played, suid): suid for suid in spotify_user_ids}
+        for future in as_completed(futures):
+            suid = futures[future]
+            try:
+                fetched_history[suid] = future.result()
+            except Exception as e:
+                app.logger.exception(f'Failed to fetch listening history for {suid}')
+                failed_users.add(suid)
+                errors[suid] = e
+
+    # write phase: one commit for the whole batch, including each user's sync state
+    new_records = []
+    new_tracks = []
+    for suid, items in fetched_history.items():
+        new_records.extend(build_history_records(suid, items or []))
+        new_tracks.extend(build_tracks(items or []))
+    try:
+        save_tracks(new_tracks, commit=False)
+        record_successful_polls(list(fetched_history), commit=False)
+        songs_saved = save_listening_history_batch(new_records)
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        app.logger.exception('Failed to save listening history')
+        failed_users.update(fetched_history)
+        errors.update({suid: e for suid in fetched_history})
+        songs_saved = 0
+
+    for suid in fetched_history:
+        if suid in failed_users:
+            continue
+        try:
+            create_listening_sessions(suid)
+        except Exception as e:
+            db.session.rollback()
+            app.logger.exception(f'Failed to create listening sessions for {suid}')
+            failed_users.add(suid)
+            errors[suid] = e
+
+    for suid, error in errors.items():
+        try:
+            record_poll_failure(suid, error)
+        except SQLAlchemyError:
+            db.session.rollback()
+            app.logger.exception(f'Failed to record sync failure for {suid}')
 
+    return {
+        'users_polled': len(spotify_user_ids),
+        'failures': len(failed_users),
+        'songs_saved': songs_saved,
+        'new_plays': {suid: len(items or []) for suid, items in fetched_history.items() if suid not in failed_users},
+        'wall_time_seconds': round(time.monotonic() - start, 3),
+    }
 
-def save_all_user_recently_played() -> None:
-    with app.app_context():
-        app.logger.info('Fetching listening history')
-        for suid in [token.spotify_user_id for token in SpotifyToken.query.all()]:
-            update_user_history(suid)
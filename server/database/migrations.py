@@ -0,0 +1,155 @@
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn
+
+from server import db, app
+from server.database.datamanager import assign_all_songs_to_listening_sessions, get_song_ids_for_activity
+from server.database.statsmanager import rebuild_all_user_stats
+from server.database.syncstate import fill_sync_state_watermarks
+from server.models import ActivityPlaylist, SpotifyToken
+
+
+def move_song_details_to_tracks() -> None:
+    """
+    Copies the song details that used to be stored on every song_history_record row into the track table
+    """
+    db.session.execute(text(
+        'INSERT INTO track (id, name, artist_name, art_link) '
+        'SELECT song_id, MAX(song_name), MAX(artist_name), MAX(art_link) FROM song_history_record '
+        'WHERE song_id NOT IN (SELECT id FROM track) '
+        'GROUP BY song_id'
+    ))
+    db.session.commit()
+
+
+def mark_app_added_playlist_tracks() -> None:
+    """
+    Marks the mirrored playlist tracks the app added. Which tracks were added before this was recorded isn't known, so
+    only tracks from the activity's sessions are marked, and any others are left alone as if the user added them
+    """
+    for activity_playlist in ActivityPlaylist.query.all():
+        song_ids = set(get_song_ids_for_activity(activity_playlist.activity_id))
+        for track in activity_playlist.tracks:
+            track.added_by_app = track.song_id in song_ids
+    db.session.commit()
+
+
+def fill_user_sync_states() -> None:
+    """
+    Fills in the user_sync_state table, moving the session cursors over from the listening_session_cursor table it
+    replaced
+    """
+    if 'listening_session_cursor' in inspect(db.engine).get_table_names():
+        db.session.execute(text(
+            'INSERT INTO user_sync_state (spotify_user_id, session_last_played_at, open_session_start, '
+            'open_session_song_count) '
+            'SELECT spotify_user_id, last_played_at, open_session_start, open_session_song_count '
+            'FROM listening_session_cursor'
+        ))
+        db.session.commit()
+    fill_sync_state_watermarks()
+
+
+def expire_stored_access_tokens() -> None:
+    """
+    Marks the access tokens saved before their expiry was recorded as expired. Their age isn't known, so they are
+    refreshed the first time they're used instead of waiting for Spotify to reject them
+    """
+    SpotifyToken.query.filter_by(expires_at=None).update({'expires_at': datetime.utcnow()})
+    db.session.commit()
+
+
+# data to fill in when a table is created in an existing database. table name -> function
+TABLE_BACKFILLS = {
+    'daily_listening_stats': rebuild_all_user_stats,
+    'user_sync_state': fill_user_sync_states,
+}
+
+# data to fill in when a column is added to an existing table. (table name, column name) -> function
+COLUMN_BACKFILLS = {
+    ('song_history_record', 'session_id'): assign_all_songs_to_listening_sessions,
+    ('playlist_track', 'added_by_app'): mark_app_added_playlist_tracks,
+    ('spotify_token', 'expires_at'): expire_stored_access_tokens,
+}
+
+# columns removed from the models. table name -> (column names, function to move their data before they are dropped)
+DROPPED_COLUMNS = {
+    'song_history_record': (['song_name', 'artist_name', 'art_link'], move_song_details_to_tracks),
+}
+
+# tables removed from the models. Their data must be moved by a `TABLE_BACKFILLS` entry before they are dropped
+DROPPED_TABLES = ['listening_session_cursor']
+
+# indexes removed from the models, usually because a newer index covers the same queries. table name -> index names
+DROPPED_INDEXES = {
+    'listening_session': ['ix_listening_session_user_activity'],
+}
+
+
+def upgrade_database() -> None:
+    """
+    Brings an existing database up to date with the models without losing any data. Missing tables are created, and
+    columns and indexes declared on the models are added to tables that were created before they existed. New columns
+    on existing tables must be nullable or have a server default. The data in columns listed in `DROPPED_COLUMNS` is
+    moved first, then new columns are filled in by their `COLUMN_BACKFILLS` entry and new tables by their
+    `TABLE_BACKFILLS` entry, if any. The `DROPPED_INDEXES` are dropped once the new indexes exist, so the backfills
+    don't have to keep them up to date. Finally the `DROPPED_COLUMNS` are dropped, and then the `DROPPED_TABLES`. Safe
+    to run more than once. Must be called inside an app context.
+    """
+    existing_tables = set(inspect(db.engine).get_table_names())
+    db.create_all()
+    backfills = []
+    # an empty database has no data to fill in
+    table_backfills = [backfill for table_name, backfill in TABLE_BACKFILLS.items()
+                       if existing_tables and table_name not in existing_tables]
+
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                app.logger.info(f'Adding column {column.name} to {table.name}')
+                column_definition = CreateColumn(column).compile(dialect=db.engine.dialect)
+                with db.engine.begin() as connection:
+                    connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column_definition}'))
+                if (table.name, column.name) in COLUMN_BACKFILLS:
+                    backfills.append(COLUMN_BACKFILLS[(table.name, column.name)])
+
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                app.logger.info(f'Creating index {index.name} on {table.name}')
+                index.create(db.engine)
+
+    for table_name, index_names in DROPPED_INDEXES.items():
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table_name)}
+        for index_name in index_names:
+            if index_name in existing_indexes:
+                app.logger.info(f'Dropping index {index_name} from {table_name}')
+                with db.engine.begin() as connection:
+                    connection.execute(text(f'DROP INDEX IF EXISTS {index_name}'))
+
+    # move data out of dropped columns first, since the backfills read it from its new place
+    columns_to_drop = {}
+    for table_name, (column_names, move_data) in DROPPED_COLUMNS.items():
+        existing_columns = {column['name'] for column in inspector.get_columns(table_name)}
+        columns_to_drop[table_name] = [name for name in column_names if name in existing_columns]
+        if columns_to_drop[table_name]:
+            move_data()
+
+    # backfill once every index exists, and new tables once every column is filled in
+    for backfill in backfills + table_backfills:
+        backfill()
+
+    for table_name, column_names in columns_to_drop.items():
+        for column_name in column_names:
+            app.logger.info(f'Dropping column {column_name} from {table_name}')
+            with db.engine.begin() as connection:
+                connection.execute(text(f'ALTER TABLE {table_name} DROP COLUMN {column_name}'))
+
+    for table_name in DROPPED_TABLES:
+        if table_name in inspector.get_table_names():
+            app.logger.info(f'Dropping table {table_name}')
+            with db.engine.begin() as connection:
+                connection.execute(text(f'DROP TABLE {table_name}'))
@@ -1,10 +1,16 @@
 from datetime import datetime
 
-from server import endpoints, db
-from server.database.datamanager import get_songs_for_listening_session
-from server.models import Activity, ActivityPlaylist, ListeningSession
+from server import endpoints, db, app
+from server.database.datamanager import get_song_ids_for_activity
+from server.models import Activity, ActivityPlaylist, PlaylistTrack
+from server.utils.asynccontext import run_in_app_context
+from server.utils.asyncspotifyapiutil import make_authorized_request_async
+from server.utils.responsecache import invalidate_user_cache
 from server.utils.spotifyapiutil import make_authorized_request
 
+# max number of tracks Spotify accepts in one request to add tracks to a playlist
+PLAYLIST_ADD_TRACKS_LIMIT = 100
+
 
 def create_playlist(spotify_user_id: str, activity_id: int) -> ActivityPlaylist:
     """
@@ -17,53 +23,133 @@ def create_playlist(spotify_user_id: str, activity_id: int) -> ActivityPlaylist:
         # a playlist already exists for this activity, don't create another
         return activity.activity_playlist
     url = endpoints.PLAYLIST_CREATE_URL.format(user_id=spotify_user_id)
-    payload = {'name': f'{activity.activity_name} Music', 'description': get_playlist_description()}
-    playlist_details = make_authorized_request(spotify_user_id, url, 'POST', payload)
-    playlist_id = playlist_details['id']
-    playlist_url = playlist_details['external_urls']['spotify']
+    playlist_details = make_authorized_request(spotify_user_id, url, 'POST', get_new_playlist_payload(activity))
+    playlist = save_created_playlist(spotify_user_id, activity.id, playlist_details)
+
+    # the description was set when the playlist was created, so it doesn't need updating again
+    sync_playlist(playlist, update_description=False)
+
+    return playlist
+
+
+async def create_playlist_async(spotify_user_id: str, activity_id: int) -> None:
+    """
+    Like `create_playlist`, but for the event loop. The Spotify request is made with the async client, and the database
+    work runs in worker threads. Songs aren't added to the new playlist, queue a sync of the playlist to add them
+    :param spotify_user_id: User to make a playlist for
+    :param activity_id: The id of the Activity to associate this playlist with
+    """
+    payload = await run_in_app_context(get_missing_playlist_payload, activity_id)
+    if payload is None:
+        return
+    url = endpoints.PLAYLIST_CREATE_URL.format(user_id=spotify_user_id)
+    playlist_details = await make_authorized_request_async(spotify_user_id, url, 'POST', payload)
+    await run_in_app_context(save_created_playlist, spotify_user_id, activity_id, playlist_details)
+
+
+def get_new_playlist_payload(activity: Activity) -> dict:
+    return {'name': f'{activity.activity_name} Music', 'description': get_playlist_description()}
+
+
+def get_missing_playlist_payload(activity_id: int) -> dict | None:
+    """
+    @return: The payload to create an activity's playlist with, or None if the activity already has a playlist
+    """
+    activity: Activity = Activity.query.filter_by(id=activity_id).first()
+    if activity.activity_playlist is not None:
+        return None
+    return get_new_playlist_payload(activity)
 
-    playlist = save_playlist(
+
+def save_created_playlist(spotify_user_id: str, activity_id: int, playlist_details: dict) -> ActivityPlaylist:
+    """
+    Saves a playlist that was just created on Spotify
+    @param playlist_details: Spotify's response to creating the playlist
+    """
+    return save_playlist(
         spotify_user_id=spotify_user_id,
-        spotify_playlist_id=playlist_id,
-        playlist_url=playlist_url,
-        activity_id=activity.id,
+        spotify_playlist_id=playlist_details['id'],
+        playlist_url=playlist_details['external_urls']['spotify'],
+        activity_id=activity_id,
+        snapshot_id=playlist_details.get('snapshot_id'),
     )
 
-    for ls in activity.listening_sessions:
-        ls_songs = get_songs_for_listening_session(ls)
-        add_songs_to_playlist(spotify_user_id, playlist_id, [song.song_id for song in ls_songs])
 
-    return playlist
+def get_playlist_snapshot_id(spotify_user_id: str, spotify_playlist_id: str) -> str:
+    """
+    Gets the current snapshot_id of a playlist, which changes whenever the playlist is modified
+    """
+    url = endpoints.PLAYLIST_MODIFY_URL.format(playlist_id=spotify_playlist_id) + '?fields=snapshot_id'
+    return make_authorized_request(spotify_user_id, url)['snapshot_id']
 
 
-def add_songs_to_playlist(spotify_user_id: str, spotify_playlist_id: int, songs: list[str]) -> None:
+def get_playlist_song_ids(spotify_user_id: str, spotify_playlist_id: str) -> list[str]:
     """
-    Adds a list of songs to a playlist
-    @param spotify_user_id: The owner of the playlist
-    @param spotify_playlist_id: id of the Activity whose playlist should be modified
-    @param songs: ids of songs to add
+    Gets the ids of every track in a playlist from Spotify
     """
-    # spotify_playlist_id = Activity.query.filter_by(id=activity_id).first().activity_playlist.spotify_playlist_id
-    add_tracks_url = endpoints.PLAYLIST_ADD_TRACKS_URL.format(playlist_id=spotify_playlist_id)
-    song_uris = [f'spotify:track:{song}' for song in songs]
-    for i in range(0, len(song_uris), 100):
-        payload = {'uris': song_uris[i:i + 100]}
-        make_authorized_request(spotify_user_id, add_tracks_url, 'POST', payload)
-
-    playlist_modify_url = endpoints.PLAYLIST_MODIFY_URL.format(playlist_id=spotify_playlist_id)
-    payload = {'description': get_playlist_description()}
-    make_authorized_request(spotify_user_id, playlist_modify_url, 'PUT', payload)
-
-
-def add_songs_from_listening_session_to_playlist(spotify_user_id: str, listening_session_id: int,
-                                                 activity_id: int) -> None:
-    activity_playlist = Activity.query.filter_by(id=activity_id).first().activity_playlist
-    if not activity_playlist:
-        return
+    url = endpoints.PLAYLIST_TRACKS_URL.format(playlist_id=spotify_playlist_id) + \
+        f'?fields=next,items(track(id))&limit={PLAYLIST_ADD_TRACKS_LIMIT}'
+    song_ids = []
+    while url:
+        page = make_authorized_request(spotify_user_id, url)
+        song_ids.extend(item['track']['id'] for item in page['items'] if item.get('track') and item['track']['id'])
+        url = page.get('next')
+    return song_ids
+
+
+def sync_playlist(activity_playlist: ActivityPlaylist, update_description: bool = True) -> None:
+    """
+    Makes an activity's playlist on Spotify contain the songs from the activity's listening sessions. Songs the app
+    added are removed once they no longer belong to the activity, songs the user added are kept. The playlist's tracks
+    are mirrored in the database, so only the difference is sent to Spotify. The mirror is only refreshed from Spotify
+    if the playlist's snapshot_id shows it was changed outside of the app.
+    @param activity_playlist: The ActivityPlaylist to sync
+    @param update_description: Whether to update the "last updated" time in the description if any tracks changed
+    """
+    spotify_user_id = activity_playlist.spotify_user_id
     spotify_playlist_id = activity_playlist.spotify_playlist_id
-    listening_session = ListeningSession.query.filter_by(id=listening_session_id).first()
-    ls_songs = get_songs_for_listening_session(listening_session)
-    add_songs_to_playlist(spotify_user_id, spotify_playlist_id, [song.song_id for song in ls_songs])
+
+    snapshot_id = get_playlist_snapshot_id(spotify_user_id, spotify_playlist_id)
+    if snapshot_id != activity_playlist.snapshot_id:
+        app.logger.info(f'Playlist {spotify_playlist_id} changed on Spotify, refreshing its mirror')
+        remote_song_ids = set(get_playlist_song_ids(spotify_user_id, spotify_playlist_id))
+        for track in [track for track in activity_playlist.tracks if track.song_id not in remote_song_ids]:
+            activity_playlist.tracks.remove(track)
+        mirrored_song_ids = {track.song_id for track in activity_playlist.tracks}
+        # tracks only seen on Spotify were added by the user, so they're never removed
+        activity_playlist.tracks.extend(PlaylistTrack(song_id=song_id, added_by_app=False)
+                                        for song_id in remote_song_ids - mirrored_song_ids)
+        activity_playlist.snapshot_id = snapshot_id
+        db.session.flush()
+
+    wanted_song_ids = dict.fromkeys(get_song_ids_for_activity(activity_playlist.activity_id))
+    mirrored_tracks = {track.song_id: track for track in activity_playlist.tracks}
+    additions = [song_id for song_id in wanted_song_ids if song_id not in mirrored_tracks]
+    removals = [song_id for song_id, track in mirrored_tracks.items()
+                if track.added_by_app and song_id not in wanted_song_ids]
+    if not additions and not removals:
+        db.session.commit()
+        return
+
+    if update_description:
+        playlist_modify_url = endpoints.PLAYLIST_MODIFY_URL.format(playlist_id=spotify_playlist_id)
+        make_authorized_request(spotify_user_id, playlist_modify_url, 'PUT',
+                                {'description': get_playlist_description()})
+
+    tracks_url = endpoints.PLAYLIST_TRACKS_URL.format(playlist_id=spotify_playlist_id)
+    for i in range(0, len(additions), PLAYLIST_ADD_TRACKS_LIMIT):
+        payload = {'uris': [f'spotify:track:{song_id}' for song_id in additions[i:i + PLAYLIST_ADD_TRACKS_LIMIT]]}
+        snapshot_id = make_authorized_request(spotify_user_id, tracks_url, 'POST', payload)['snapshot_id']
+    for i in range(0, len(removals), PLAYLIST_ADD_TRACKS_LIMIT):
+        payload = {'tracks': [{'uri': f'spotify:track:{song_id}'}
+                              for song_id in removals[i:i + PLAYLIST_ADD_TRACKS_LIMIT]]}
+        snapshot_id = make_authorized_request(spotify_user_id, tracks_url, 'DELETE', payload)['snapshot_id']
+
+    for song_id in removals:
+        activity_playlist.tracks.remove(mirrored_tracks[song_id])
+    activity_playlist.tracks.extend(PlaylistTrack(song_id=song_id, added_by_app=True) for song_id in additions)
+    activity_playlist.snapshot_id = snapshot_id
+    db.session.commit()
 
 
 def get_playlist_description() -> str:
@@ -72,13 +158,16 @@ def get_playlist_description() -> str:
     return f'Playlist created by the Queuecumber app. Last updated on {d.month}/{d.day}/{d.year} at {d_hour}:{d.minute:02} {d:%p}'
 
 
-def save_playlist(spotify_user_id: str, spotify_playlist_id: str, playlist_url: str, activity_id: int) -> ActivityPlaylist:
+def save_playlist(spotify_user_id: str, spotify_playlist_id: str, playlist_url: str, activity_id: int,
+                  snapshot_id: str = None) -> ActivityPlaylist:
     ap = ActivityPlaylist(
         spotify_user_id=spotify_user_id,
         spotify_playlist_id=spotify_playlist_id,
         playlist_url=playlist_url,
-        activity_id=activity_id
+        activity_id=activity_id,
+        snapshot_id=snapshot_id
     )
     db.session.add(ap)
     db.session.commit()
+    invalidate_user_cache(spotify_user_id, 'playlists')
     return ap
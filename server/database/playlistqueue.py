@@ -0,0 +1,135 @@
+from datetime import datetime, timedelta
+
+from server import db, app
+from server.database.datamanager import insert_ignoring_conflicts
+from server.database.playlistmanager import sync_playlist
+from server.models import ActivityPlaylist, PlaylistSyncJob
+from server.utils.ratelimiter import request_priority, BACKGROUND
+
+
+def enqueue_playlist_sync(activity_id: int) -> None:
+    """
+    Queues a sync of an activity's playlist, if it has one, to be run by a background worker. If a sync is already
+    queued for the playlist, the two are merged.
+    @param activity_id: id of the Activity whose playlist changed
+    """
+    activity_playlist = ActivityPlaylist.query.filter_by(activity_id=activity_id).first()
+    if activity_playlist is None:
+        return
+    now = datetime.utcnow()
+    db.session.execute(insert_ignoring_conflicts(PlaylistSyncJob).values(
+        activity_playlist_id=activity_playlist.id,
+        spotify_user_id=activity_playlist.spotify_user_id,
+        requested_at=now,
+        next_attempt_at=now,
+        attempts=0
+    ))
+    # if the job already existed, make sure it runs again even if a worker is in the middle of it
+    db.session.execute(
+        db.update(PlaylistSyncJob)
+        .where(PlaylistSyncJob.activity_playlist_id == activity_playlist.id)
+        .values(requested_at=now)
+    )
+    db.session.commit()
+
+
+def sync_job_lease_is_free(now: datetime):
+    return PlaylistSyncJob.lease_expires_at.is_(None) | (PlaylistSyncJob.lease_expires_at < now)
+
+
+def claim_playlist_sync_jobs(worker_id: str, limit: int, lease_seconds: int) -> list[PlaylistSyncJob]:
+    """
+    Leases up to `limit` due playlist sync jobs to a worker, so each playlist is only synced by one worker at a time
+    @param worker_id: Unique name of the worker claiming the jobs
+    @param limit: Max number of jobs to claim
+    @param lease_seconds: How long the worker has to finish the jobs before they can be claimed by another worker
+    @return: The claimed PlaylistSyncJob objects
+    """
+    now = datetime.utcnow()
+    candidate_ids = [job_id for job_id, in db.session.query(PlaylistSyncJob.id)
+                     .filter(PlaylistSyncJob.next_attempt_at <= now)
+                     .filter(sync_job_lease_is_free(now))
+                     .order_by(PlaylistSyncJob.requested_at)
+                     .limit(limit)]
+
+    claimed_ids = []
+    for job_id in candidate_ids:
+        result = db.session.execute(
+            db.update(PlaylistSyncJob)
+            .where(PlaylistSyncJob.id == job_id)
+            .where(sync_job_lease_is_free(now))
+            .values(lease_owner=worker_id, lease_expires_at=now + timedelta(seconds=lease_seconds))
+        )
+        if result.rowcount == 1:
+            claimed_ids.append(job_id)
+    db.session.commit()
+
+    if not claimed_ids:
+        return []
+    return PlaylistSyncJob.query.filter(PlaylistSyncJob.id.in_(claimed_ids)).all()
+
+
+def run_playlist_sync_job(job: PlaylistSyncJob) -> bool:
+    """
+    Syncs a claimed job's playlist, then removes the job. If the sync fails, the job is retried later with exponential
+    backoff. If the playlist was changed again while it was syncing, the job is kept so the new changes are picked up.
+    @param job: The claimed PlaylistSyncJob
+    @return: Whether the sync succeeded
+    """
+    started_at = datetime.utcnow()
+    job_filter = (PlaylistSyncJob.id == job.id) & (PlaylistSyncJob.lease_owner == job.lease_owner)
+    activity_playlist = ActivityPlaylist.query.filter_by(id=job.activity_playlist_id).first()
+    try:
+        if activity_playlist is not None:
+            sync_playlist(activity_playlist)
+    except Exception as e:
+        db.session.rollback()
+        app.logger.exception(f'Failed to sync playlist {job.activity_playlist_id}')
+        retry_delay = min(60 * 2 ** job.attempts, 3600)
+        db.session.execute(db.update(PlaylistSyncJob).where(job_filter).values(
+            attempts=PlaylistSyncJob.attempts + 1,
+            last_error=str(e),
+            next_attempt_at=datetime.utcnow() + timedelta(seconds=retry_delay),
+            lease_owner=None,
+            lease_expires_at=None
+        ))
+        db.session.commit()
+        return False
+
+    db.session.execute(db.delete(PlaylistSyncJob).where(job_filter).where(PlaylistSyncJob.requested_at < started_at))
+    # the playlist changed while it was syncing, so the job stays queued. This sync worked, so its backoff starts over
+    db.session.execute(db.update(PlaylistSyncJob).where(job_filter).values(
+        attempts=0,
+        last_error=None,
+        lease_owner=None,
+        lease_expires_at=None
+    ))
+    db.session.commit()
+    return True
+
+
+def process_playlist_sync_jobs(worker_id: str, limit: int, lease_seconds: int) -> int:
+    """
+    Claims and runs due playlist sync jobs. Their requests are sent in the background priority lane, behind requests
+    from the API endpoints.
+    @return: The number of jobs that were run
+    """
+    jobs = claim_playlist_sync_jobs(worker_id, limit, lease_seconds)
+    with request_priority(BACKGROUND):
+        for job in jobs:
+            run_playlist_sync_job(job)
+    return len(jobs)
+
+
+def get_pending_playlist_syncs(spotify_user_id: str) -> list[PlaylistSyncJob]:
+    """
+    @return: The user's playlist sync jobs that haven't finished yet
+    """
+    return PlaylistSyncJob.query.filter_by(spotify_user_id=spotify_user_id).order_by(PlaylistSyncJob.requested_at).all()
+
+
+def get_next_playlist_sync_time() -> datetime:
+    """
+    @return: When the next playlist sync job is due, or None if there are no jobs
+    """
+    return db.session.query(db.func.min(PlaylistSyncJob.next_attempt_at)).scalar()
@@ -0,0 +1,100 @@
+import random
+from datetime import datetime, timedelta
+
+from server import db
+from server.database.datamanager import insert_ignoring_conflicts
+from server.models import PollJob, SpotifyToken
+from server.utils.pollplanner import plan_next_poll
+
+
+def ensure_poll_jobs(spotify_user_ids: list[str], spread_seconds: int = 0) -> None:
+    """
+    Creates poll jobs for users that don't have one yet
+    @param spotify_user_ids: The users to create jobs for
+    @param spread_seconds: The new jobs are first due at random times up to this many seconds from now, so that a
+    large number of new jobs don't all run at once
+    """
+    if not spotify_user_ids:
+        return
+    now = datetime.utcnow()
+    db.session.execute(insert_ignoring_conflicts(PollJob).values([{
+        'spotify_user_id': suid,
+        'next_run_at': now + timedelta(seconds=random.uniform(0, spread_seconds))
+    } for suid in spotify_user_ids]))
+    db.session.commit()
+
+
+def ensure_all_poll_jobs(spread_seconds: int = 0) -> None:
+    """
+    Creates poll jobs for every user with saved Spotify tokens that doesn't have one yet
+    @param spread_seconds: See `ensure_poll_jobs`
+    """
+    ensure_poll_jobs([suid for suid, in db.session.query(SpotifyToken.spotify_user_id)
+                     .outerjoin(PollJob, PollJob.spotify_user_id == SpotifyToken.spotify_user_id)
+                     .filter(PollJob.id.is_(None))], spread_seconds)
+
+
+def lease_is_free(now: datetime):
+    return PollJob.lease_expires_at.is_(None) | (PollJob.lease_expires_at < now)
+
+
+def claim_due_poll_jobs(worker_id: str, limit: int, lease_seconds: int) -> list[str]:
+    """
+    Leases up to `limit` due poll jobs to a worker. A job is only claimed if its lease is free, so a user is never
+    polled by two workers at once. If a worker dies, its leases expire and the jobs can be claimed again.
+    @param worker_id: Unique name of the worker claiming the jobs
+    @param limit: Max number of jobs to claim
+    @param lease_seconds: How long the worker has to finish the jobs before they can be claimed by another worker
+    @return: The spotify user ids of the claimed jobs
+    """
+    now = datetime.utcnow()
+    candidate_ids = [job_id for job_id, in db.session.query(PollJob.id)
+                     .filter(PollJob.next_run_at <= now)
+                     .filter(lease_is_free(now))
+                     .order_by(PollJob.next_run_at)
+                     .limit(limit)]
+
+    claimed_ids = []
+    for job_id in candidate_ids:
+        # the lease conditions are checked again in the UPDATE, in case another worker claimed the job first
+        result = db.session.execute(
+            db.update(PollJob)
+            .where(PollJob.id == job_id)
+            .where(PollJob.next_run_at <= now)
+            .where(lease_is_free(now))
+            .values(lease_owner=worker_id, lease_expires_at=now + timedelta(seconds=lease_seconds))
+        )
+        if result.rowcount == 1:
+            claimed_ids.append(job_id)
+    db.session.commit()
+
+    if not claimed_ids:
+        return []
+    return [suid for suid, in db.session.query(PollJob.spotify_user_id).filter(PollJob.id.in_(claimed_ids))]
+
+
+def complete_poll_jobs(worker_id: str, spotify_user_ids: list[str], new_plays: dict[str, int]) -> None:
+    """
+    Releases a worker's leases on poll jobs and plans each job's next run from the results of the poll
+    @param worker_id: The worker that claimed the jobs
+    @param spotify_user_ids: The users that were polled
+    @param new_plays: The number of songs found for each user. Users missing from this dict failed to be polled
+    """
+    now = datetime.utcnow()
+    jobs = PollJob.query.filter(PollJob.spotify_user_id.in_(spotify_user_ids)) \
+        .filter(PollJob.lease_owner == worker_id).all()
+    for job in jobs:
+        job.next_run_at, job.play_rate, job.poll_interval_seconds = \
+            plan_next_poll(job, new_plays.get(job.spotify_user_id), now)
+        if job.spotify_user_id in new_plays:
+            job.last_run_at = now
+        job.lease_owner = None
+        job.lease_expires_at = None
+    db.session.commit()
+
+
+def get_next_poll_time() -> datetime:
+    """
+    @return: When the next poll job is due, or None if there are no jobs
+    """
+    return db.session.query(db.func.min(PollJob.next_run_at)).scalar()
@@ -0,0 +1,44 @@
+from typing import Callable
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from server import db
+
+
+def get_transaction_info() -> dict:
+    """
+    Returns a dict for keeping state about the database session's current transaction. It's cleared once the transaction
+    is committed or rolled back. Must be called inside an app context
+    """
+    return db.session.info.setdefault('transaction', {})
+
+
+def run_after_commit(callback: Callable[[], None]) -> None:
+    """
+    Runs `callback` once the database session's current transaction is committed. If it's rolled back instead, the
+    callback is dropped. Used to update caches only with data that was actually saved
+    @param callback: Function to call, without arguments
+    """
+    get_transaction_info().setdefault('after_commit', []).append(callback)
+
+
+def run_after_transaction(callback: Callable[[], None]) -> None:
+    """
+    Runs `callback` once the database session's current transaction ends, whether it's committed, rolled back or closed
+    @param callback: Function to call, without arguments
+    """
+    get_transaction_info().setdefault('after_transaction', []).append(callback)
+
+
+@event.listens_for(Session, 'after_commit')
+def run_after_commit_callbacks(session: Session) -> None:
+    for callback in session.info.get('transaction', {}).pop('after_commit', []):
+        callback()
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def run_after_transaction_callbacks(session: Session, transaction) -> None:
+    if transaction.parent is None:
+        for callback in session.info.pop('transaction', {}).get('after_transaction', []):
+            callback()
@@ -0,0 +1,24 @@
+import sqlite3
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from server import app
+
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    """
+    Applies the SQLITE_* settings from the config to every new SQLite connection. Connections to other databases are
+    left alone
+    """
+    if not isinstance(dbapi_connection, sqlite3.Connection) or not app.config.get('SQLITE_PRAGMAS_ENABLED'):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f'PRAGMA journal_mode={app.config.get("SQLITE_JOURNAL_MODE")}')
+    cursor.execute(f'PRAGMA synchronous={app.config.get("SQLITE_SYNCHRONOUS")}')
+    cursor.execute(f'PRAGMA busy_timeout={int(app.config.get("SQLITE_BUSY_TIMEOUT_MS"))}')
+    cursor.execute(f'PRAGMA mmap_size={int(app.config.get("SQLITE_MMAP_SIZE"))}')
+    # negative values are in KiB instead of pages
+    cursor.execute(f'PRAGMA cache_size={-int(app.config.get("SQLITE_CACHE_SIZE_KIB"))}')
+    cursor.close()
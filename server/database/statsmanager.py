@@ -0,0 +1,235 @@
+from collections import Counter
+from datetime import date, datetime
+
+from sqlalchemy import select, delete, func, union, union_all
+from sqlalchemy.dialects import sqlite, postgresql, mysql
+
+from server import db
+from server.database.historyarchive import get_history_tables
+from server.models import DailyListeningStats, ArtistListeningStats, ActivityListeningStats, ListeningSession, Track
+from server.utils.responsecache import invalidate_user_cache
+
+# Listening statistics are kept in rollup tables, one row per user and day, artist or activity. Plays are added as
+# they're saved and sessions as they're labeled, so reading stats only costs as many rows as there are buckets.
+
+
+def upsert_adding(model: type[db.Model], rows: list[dict], key_columns: list[str], added_columns: list[str],
+                  latest_columns: list[str] = ()) -> None:
+    """
+    Inserts rows, or for rows whose key already exists, adds to the existing values instead
+    @param model: The table to upsert into. Must have a unique constraint on `key_columns`
+    @param rows: dicts with a value for each key, added and latest column
+    @param key_columns: The columns identifying a row
+    @param added_columns: The columns whose new values are added to the existing ones
+    @param latest_columns: The columns that keep the larger of the existing and new value
+    """
+    if not rows:
+        return
+    table = model.__table__
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('mysql', 'mariadb'):
+        statement = mysql.insert(table)
+        new_values = statement.inserted
+    else:
+        statement = (sqlite if dialect == 'sqlite' else postgresql).insert(table)
+        new_values = statement.excluded
+    greatest = func.max if dialect == 'sqlite' else func.greatest
+    updates = {column: table.c[column] + new_values[column] for column in added_columns}
+    # coalesce, because SQLite's max() is NULL if either value is
+    updates.update({column: greatest(func.coalesce(table.c[column], new_values[column]), new_values[column])
+                    for column in latest_columns})
+    if dialect in ('mysql', 'mariadb'):
+        statement = statement.on_duplicate_key_update(updates)
+    else:
+        statement = statement.on_conflict_do_update(index_elements=key_columns, set_=updates)
+    db.session.execute(statement, rows)
+
+
+def add_plays_to_stats(records: list[dict], artist_names: dict[str, str]) -> None:
+    """
+    Adds newly saved plays to the daily and artist stats. Doesn't commit
+    @param records: The saved listening history, as dicts with spotify_user_id, song_id and played_at
+    @param artist_names: The artist of each song. song id -> artist name
+    """
+    daily_counts = Counter()
+    artist_counts = Counter()
+    artist_last_played: dict[tuple[str, str], datetime] = {}
+    for record in records:
+        daily_counts[record['spotify_user_id'], record['played_at'].date()] += 1
+        artist_name = artist_names.get(record['song_id'])
+        if artist_name is None:
+            continue
+        artist_key = (record['spotify_user_id'], artist_name)
+        artist_counts[artist_key] += 1
+        artist_last_played[artist_key] = max(artist_last_played.get(artist_key, record['played_at']),
+                                             record['played_at'])
+
+    upsert_adding(DailyListeningStats, [
+        {'spotify_user_id': suid, 'day': day, 'play_count': count} for (suid, day), count in daily_counts.items()
+    ], ['spotify_user_id', 'day'], ['play_count'])
+    upsert_adding(ArtistListeningStats, [
+        {'spotify_user_id': suid, 'artist_name': artist_name, 'play_count': count,
+         'last_played_at': artist_last_played[suid, artist_name]}
+        for (suid, artist_name), count in artist_counts.items()
+    ], ['spotify_user_id', 'artist_name'], ['play_count'], ['last_played_at'])
+    for spotify_user_id in {record['spotify_user_id'] for record in records}:
+        invalidate_user_cache(spotify_user_id, 'stats')
+
+
+def count_session_songs(ls: ListeningSession) -> int:
+    return sum(
+        db.session.scalar(select(func.count()).select_from(table).where(table.c.session_id == ls.id))
+        for table in get_history_tables(ls.start_time, ls.end_time)
+    )
+
+
+def move_session_activity_stats(ls: ListeningSession, old_activity_id: int | None,
+                                new_activity_id: int | None) -> None:
+    """
+    Moves a listening session's songs and listening time from its old activity's stats to its new one's, when it's
+    relabeled. Doesn't commit
+    @param ls: The ListeningSession being relabeled
+    @param old_activity_id: The activity the session was labeled with, or None if it was unlabeled
+    @param new_activity_id: The activity the session is now labeled with, or None if it's being unlabeled
+    """
+    if old_activity_id == new_activity_id:
+        return
+    play_count = count_session_songs(ls)
+    listening_seconds = int((ls.end_time - ls.start_time).total_seconds())
+    rows = []
+    for activity_id, sign in ((old_activity_id, -1), (new_activity_id, 1)):
+        if activity_id is not None:
+            rows.append({
+                'spotify_user_id': ls.spotify_user_id,
+                'activity_id': activity_id,
+                'session_count': sign,
+                'play_count': sign * play_count,
+                'listening_seconds': sign * listening_seconds
+            })
+    upsert_adding(ActivityListeningStats, rows, ['spotify_user_id', 'activity_id'],
+                  ['session_count', 'play_count', 'listening_seconds'])
+    invalidate_user_cache(ls.spotify_user_id, 'stats')
+
+
+def delete_activity_stats(activity_id: int) -> None:
+    """
+    Removes a deleted activity's stats. Doesn't commit
+    """
+    db.session.execute(delete(ActivityListeningStats).where(ActivityListeningStats.activity_id == activity_id))
+
+
+def rebuild_activity_stats(spotify_user_ids: list[str]) -> None:
+    """
+    Recomputes the activity stats of a batch of users from their labeled listening sessions, e.g. after their sessions
+    are rebuilt. Doesn't commit
+    @param spotify_user_ids: The users to recompute stats for
+    """
+    sessions = db.session.execute(
+        select(ListeningSession.id, ListeningSession.spotify_user_id, ListeningSession.activity_id,
+               ListeningSession.start_time, ListeningSession.end_time)
+        .where(ListeningSession.spotify_user_id.in_(spotify_user_ids))
+        .where(ListeningSession.activity_id.isnot(None))
+    ).all()
+    session_song_counts = Counter()
+    labeled_session_ids = select(ListeningSession.id) \
+        .where(ListeningSession.spotify_user_id.in_(spotify_user_ids)) \
+        .where(ListeningSession.activity_id.isnot(None))
+    for table in get_history_tables():
+        session_song_counts.update(dict(db.session.execute(
+            select(table.c.session_id, func.count())
+            .where(table.c.session_id.in_(labeled_session_ids))
+            .group_by(table.c.session_id)
+        ).all()))
+
+    activity_stats: dict[tuple[str, int], dict] = {}
+    for session_id, suid, activity_id, start_time, end_time in sessions:
+        stats = activity_stats.setdefault((suid, activity_id), {
+            'spotify_user_id': suid, 'activity_id': activity_id,
+            'session_count': 0, 'play_count': 0, 'listening_seconds': 0
+        })
+        stats['session_count'] += 1
+        stats['play_count'] += session_song_counts[session_id]
+        stats['listening_seconds'] += int((end_time - start_time).total_seconds())
+
+    db.session.execute(
+        delete(ActivityListeningStats).where(ActivityListeningStats.spotify_user_id.in_(spotify_user_ids))
+    )
+    if activity_stats:
+        db.session.execute(ActivityListeningStats.__table__.insert(), list(activity_stats.values()))
+    for spotify_user_id in spotify_user_ids:
+        invalidate_user_cache(spotify_user_id, 'stats')
+
+
+def rebuild_user_stats(spotify_user_ids: list[str], batch_size: int = 5000) -> None:
+    """
+    Recomputes every stat of a batch of users from their full listening history, including archived history. Used to
+    fill in stats for history saved before they existed
+    @param spotify_user_ids: The users to recompute stats for
+    @param batch_size: How many songs to load into memory at once
+    """
+    db.session.execute(delete(DailyListeningStats).where(DailyListeningStats.spotify_user_id.in_(spotify_user_ids)))
+    db.session.execute(delete(ArtistListeningStats).where(ArtistListeningStats.spotify_user_id.in_(spotify_user_ids)))
+    plays = union_all(*[
+        select(table.c.spotify_user_id, table.c.song_id, table.c.played_at)
+        .where(table.c.spotify_user_id.in_(spotify_user_ids))
+        for table in get_history_tables()
+    ]).subquery()
+    statement = select(plays.c.spotify_user_id, plays.c.song_id, plays.c.played_at, Track.artist_name) \
+        .outerjoin(Track, Track.id == plays.c.song_id) \
+        .execution_options(yield_per=batch_size)
+    for partition in db.session.execute(statement).partitions():
+        add_plays_to_stats(
+            [{'spotify_user_id': suid, 'song_id': song_id, 'played_at': played_at}
+             for suid, song_id, played_at, _ in partition],
+            {song_id: artist_name for _, song_id, _, artist_name in partition if artist_name is not None}
+        )
+    rebuild_activity_stats(spotify_user_ids)
+    db.session.commit()
+
+
+def rebuild_all_user_stats(batch_size: int = 500) -> None:
+    """
+    Recomputes the stats of every user with listening history, `batch_size` users at a time
+    """
+    spotify_user_ids = [suid for suid, in db.session.execute(
+        union(*[select(table.c.spotify_user_id) for table in get_history_tables()]).order_by('spotify_user_id')
+    )]
+    for i in range(0, len(spotify_user_ids), batch_size):
+        rebuild_user_stats(spotify_user_ids[i:i + batch_size])
+
+
+def get_daily_stats(spotify_user_id: str, start: date = None, end: date = None) -> list[DailyListeningStats]:
+    """
+    Get a user's plays per day, oldest first. Days without plays are left out
+    @param spotify_user_id: The user to get stats for
+    @param start: First day to include, or None for no lower bound
+    @param end: Last day to include, or None for no upper bound
+    @return: The list of DailyListeningStats objects
+    """
+    query = DailyListeningStats.query.filter(DailyListeningStats.spotify_user_id == spotify_user_id)
+    if start:
+        query = query.filter(DailyListeningStats.day >= start)
+    if end:
+        query = query.filter(DailyListeningStats.day <= end)
+    return query.order_by(DailyListeningStats.day).all()
+
+
+def get_top_artists(spotify_user_id: str, limit: int) -> list[ArtistListeningStats]:
+    """
+    Get the artists a user has played the most songs by, most played first
+    @param spotify_user_id: The user to get stats for
+    @param limit: The max number of artists to return
+    @return: The list of ArtistListeningStats objects
+    """
+    return ArtistListeningStats.query.filter(ArtistListeningStats.spotify_user_id == spotify_user_id) \
+        .order_by(ArtistListeningStats.play_count.desc()).limit(limit).all()
+
+
+def get_activity_stats(spotify_user_id: str) -> list[ActivityListeningStats]:
+    """
+    Get the listening stats for each of a user's activities that has labeled sessions
+    @param spotify_user_id: The user to get stats for
+    @return: The list of ActivityListeningStats objects
+    """
+    return ActivityListeningStats.query.filter(ActivityListeningStats.spotify_user_id == spotify_user_id) \
+        .filter(ActivityListeningStats.session_count > 0).all()
@@ -0,0 +1,157 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, bindparam, func, union
+
+from server import db, app
+from server.database.datamanager import insert_ignoring_conflicts
+from server.database.historyarchive import get_history_tables
+from server.models import UserSyncState, PollJob
+
+# longest error message stored in UserSyncState.last_error
+MAX_ERROR_LENGTH = 1000
+
+
+def ensure_sync_states(spotify_user_ids: list[str]) -> None:
+    """
+    Creates a sync state row for each user that doesn't have one yet. Doesn't commit
+    """
+    if spotify_user_ids:
+        db.session.execute(insert_ignoring_conflicts(UserSyncState).values([
+            {'spotify_user_id': suid, 'open_session_song_count': 0} for suid in spotify_user_ids
+        ]))
+
+
+def get_sync_state(spotify_user_id: str) -> UserSyncState | None:
+    return db.session.get(UserSyncState, spotify_user_id)
+
+
+def get_or_create_sync_state(spotify_user_id: str) -> UserSyncState:
+    """
+    Gets a user's sync state, creating it if it doesn't exist yet. Doesn't commit
+    """
+    sync_state = db.session.get(UserSyncState, spotify_user_id)
+    if sync_state is None:
+        ensure_sync_states([spotify_user_id])
+        sync_state = db.session.get(UserSyncState, spotify_user_id)
+    return sync_state
+
+
+def get_ingest_watermark(spotify_user_id: str) -> datetime | None:
+    """
+    Get when the newest song saved for a user was played, read from their sync state
+    @return: The played_at time, or None if nothing has been saved for the user
+    """
+    return db.session.scalar(
+        select(UserSyncState.latest_played_at).where(UserSyncState.spotify_user_id == spotify_user_id)
+    )
+
+
+def get_last_polled_at(spotify_user_id: str) -> datetime | None:
+    """
+    Get when a user's history was last synced successfully
+    """
+    return db.session.scalar(
+        select(UserSyncState.last_polled_at).where(UserSyncState.spotify_user_id == spotify_user_id)
+    )
+
+
+def record_successful_polls(spotify_user_ids: list[str], commit: bool = True) -> None:
+    """
+    Records that the users' history was just fetched from Spotify. Pass `commit=False` to commit along with the songs
+    that were fetched
+    """
+    if not spotify_user_ids:
+        return
+    ensure_sync_states(spotify_user_ids)
+    db.session.execute(
+        update(UserSyncState)
+        .where(UserSyncState.spotify_user_id.in_(spotify_user_ids))
+        .values(last_polled_at=datetime.utcnow())
+    )
+    if commit:
+        db.session.commit()
+
+
+def record_poll_failure(spotify_user_id: str, error: Exception) -> None:
+    """
+    Records that syncing a user's history failed. Commits
+    @param spotify_user_id: The user whose sync failed
+    @param error: The exception that made it fail
+    """
+    ensure_sync_states([spotify_user_id])
+    db.session.execute(
+        update(UserSyncState)
+        .where(UserSyncState.spotify_user_id == spotify_user_id)
+        .values(last_error=f'{type(error).__name__}: {error}'[:MAX_ERROR_LENGTH], last_error_at=datetime.utcnow())
+    )
+    db.session.commit()
+
+
+def is_sync_failing(sync_state: UserSyncState) -> bool:
+    """
+    @return: Whether the user's latest sync failed
+    """
+    return sync_state.last_error_at is not None and \
+        (sync_state.last_polled_at is None or sync_state.last_error_at > sync_state.last_polled_at)
+
+
+def get_sync_health_summary(stale_after: timedelta) -> dict:
+    """
+    Summarizes how up to date every user's history is
+    @param stale_after: Users not synced for this long count as stale
+    @return: Number of users with a sync state, never synced, stale, and whose latest sync failed, and the ids of the
+    failing users
+    """
+    stale_before = datetime.utcnow() - stale_after
+    sync_states = UserSyncState.query.all()
+    failing = [sync_state.spotify_user_id for sync_state in sync_states if is_sync_failing(sync_state)]
+    return {
+        'users': len(sync_states),
+        'never_synced': sum(sync_state.last_polled_at is None for sync_state in sync_states),
+        'stale': sum(sync_state.last_polled_at is not None and sync_state.last_polled_at < stale_before
+                     for sync_state in sync_states),
+        'failing': len(failing),
+        'failing_users': failing,
+    }
+
+
+def fill_sync_state_watermarks() -> None:
+    """
+    Sets the ingest watermark and last poll time of every user from their saved history and poll job, for history
+    saved before sync states existed
+    """
+    history_tables = get_history_tables()
+    spotify_user_ids = list(db.session.scalars(
+        union(*[select(table.c.spotify_user_id) for table in history_tables], select(PollJob.spotify_user_id))
+    ))
+    for i in range(0, len(spotify_user_ids), 500):
+        ensure_sync_states(spotify_user_ids[i:i + 500])
+
+    # the hot table has the newest songs, so only fall back to archives for users without hot songs
+    latest_played_at = {}
+    for table in history_tables:
+        for suid, played_at in db.session.execute(
+            select(table.c.spotify_user_id, func.max(table.c.played_at)).group_by(table.c.spotify_user_id)
+        ):
+            latest_played_at.setdefault(suid, played_at)
+    if latest_played_at:
+        db.session.connection().execute(
+            update(UserSyncState)
+            .where(UserSyncState.spotify_user_id == bindparam('b_spotify_user_id'))
+            .values(latest_played_at=bindparam('b_latest_played_at')),
+            [{'b_spotify_user_id': suid, 'b_latest_played_at': played_at}
+             for suid, played_at in latest_played_at.items()]
+        )
+
+    last_run_at = db.session.execute(
+        select(PollJob.spotify_user_id, PollJob.last_run_at).where(PollJob.last_run_at.isnot(None))
+    ).all()
+    if last_run_at:
+        db.session.connection().execute(
+            update(UserSyncState)
+            .where(UserSyncState.spotify_user_id == bindparam('b_spotify_user_id'))
+            .values(last_polled_at=bindparam('b_last_polled_at')),
+            [{'b_spotify_user_id': suid, 'b_last_polled_at': polled_at} for suid, polled_at in last_run_at]
+        )
+    db.session.commit()
+    app.logger.info(f'Filled in sync state for {len(spotify_user_ids)} users')
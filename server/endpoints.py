@@ -4,4 +4,4 @@ ME_URL = 'https://api.spotify.com/v1/me'
 HISTORY_URL = 'https://api.spotify.com/v1/me/player/recently-played'
 PLAYLIST_CREATE_URL = 'https://api.spotify.com/v1/users/{user_id}/playlists'
 PLAYLIST_MODIFY_URL = 'https://api.spotify.com/v1/playlists/{playlist_id}'
-PLAYLIST_ADD_TRACKS_URL = 'https://api.spotify.com/v1/playlists/{playlist_id}/tracks'
+PLAYLIST_TRACKS_URL = 'https://api.spotify.com/v1/playlists/{playlist_id}/tracks'
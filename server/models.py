@@ -9,6 +9,8 @@ class SpotifyToken(db.Model):
     spotify_user_id = db.Column(db.String, unique=True, nullable=False)
     access_token = db.Column(db.String, nullable=False)
     refresh_token = db.Column(db.String, nullable=False)
+    # when access_token expires, in UTC. Unknown for tokens saved without an expiry
+    expires_at = db.Column(db.DateTime)
 
 
 class Activity(db.Model):
@@ -16,7 +18,7 @@ class Activity(db.Model):
     Table to store activities for users
     """
     id = db.Column(db.Integer, primary_key=True)
-    spotify_user_id = db.Column(db.String, nullable=False)
+    spotify_user_id = db.Column(db.String, nullable=False, index=True)
     activity_name = db.Column(db.String, nullable=False, unique=True)
     listening_sessions = db.relationship('ListeningSession', lazy=True)
     activity_playlist = db.relationship('ActivityPlaylist', uselist=False, lazy=True)
@@ -26,6 +28,11 @@ class ListeningSession(db.Model):
     """
     Table to store listening sessions for users
     """
+    __table_args__ = (
+        db.Index('ix_listening_session_user_end_time', 'spotify_user_id', 'end_time'),
+        db.Index('ix_listening_session_user_activity_end_time', 'spotify_user_id', 'activity_id', 'end_time'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     spotify_user_id = db.Column(db.String, nullable=False)
     start_time = db.Column(db.DateTime)
@@ -33,17 +40,49 @@ class ListeningSession(db.Model):
     activity_id = db.Column(db.Integer, db.ForeignKey('activity.id'), nullable=True)
 
 
+class UserSyncState(db.Model):
+    """
+    Table to store where each user's history sync is up to, one row per user:
+    - `latest_played_at` is the newest song saved, so the next poll only asks Spotify for songs after it. Updated in
+      the same transaction as the songs
+    - `last_polled_at`, `last_error` and `last_error_at` record how the latest polls went
+    - the session cursor records how far the history has been split into listening sessions. Songs after
+      `session_last_played_at` haven't been processed yet, and the songs since `open_session_start` belong to a session
+      that hasn't ended yet
+    """
+    spotify_user_id = db.Column(db.String, primary_key=True)
+    latest_played_at = db.Column(db.DateTime)
+    last_polled_at = db.Column(db.DateTime)
+    last_error = db.Column(db.String)
+    last_error_at = db.Column(db.DateTime)
+    session_last_played_at = db.Column(db.DateTime)
+    open_session_start = db.Column(db.DateTime)
+    open_session_song_count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class Track(db.Model):
+    """
+    Table to store the details of each song, shared by every user's listening history
+    """
+    id = db.Column(db.String, primary_key=True)
+    name = db.Column(db.String, nullable=False)
+    artist_name = db.Column(db.String, nullable=False)
+    art_link = db.Column(db.String)
+
+
 class SongHistoryRecord(db.Model):
     """
     Table to store the songs users listen to
     """
+    __table_args__ = (
+        db.Index('ix_song_history_record_user_played_at', 'spotify_user_id', 'played_at'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     spotify_user_id = db.Column(db.String, nullable=False)
-    song_id = db.Column(db.String, nullable=False)
-    song_name = db.Column(db.String, nullable=False)
-    artist_name = db.Column(db.String, nullable=False)
-    art_link = db.Column(db.String)
+    song_id = db.Column(db.String, db.ForeignKey('track.id'), nullable=False)
     played_at = db.Column(db.DateTime, unique=True)
+    session_id = db.Column(db.Integer, db.ForeignKey('listening_session.id'), nullable=True, index=True)
 
 
 class ActivityPlaylist(db.Model):
@@ -55,3 +94,99 @@ class ActivityPlaylist(db.Model):
     spotify_playlist_id = db.Column(db.String, nullable=False)
     playlist_url = db.Column(db.String, nullable=False)
     activity_id = db.Column(db.Integer, db.ForeignKey('activity.id'), unique=True)
+    # Spotify's version of the playlist that `tracks` mirrors
+    snapshot_id = db.Column(db.String)
+    tracks = db.relationship('PlaylistTrack', lazy=True, cascade='all, delete-orphan')
+
+
+class PlaylistTrack(db.Model):
+    """
+    Table mirroring the tracks in each activity playlist on Spotify, as of the playlist's snapshot_id. Only tracks the
+    app added itself are ever removed by it, so tracks the user added to the playlist are left alone
+    """
+    __table_args__ = (
+        db.UniqueConstraint('activity_playlist_id', 'song_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    activity_playlist_id = db.Column(db.Integer, db.ForeignKey('activity_playlist.id'), nullable=False)
+    song_id = db.Column(db.String, nullable=False)
+    added_by_app = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
+
+
+class PollJob(db.Model):
+    """
+    Table to store when each user's listening history is next due to be polled, and which worker holds the lease to
+    poll it
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    spotify_user_id = db.Column(db.String, unique=True, nullable=False)
+    next_run_at = db.Column(db.DateTime, nullable=False, index=True)
+    last_run_at = db.Column(db.DateTime)
+    # recent plays per hour, and the current time between polls, used to plan the next poll
+    play_rate = db.Column(db.Float)
+    poll_interval_seconds = db.Column(db.Integer)
+    lease_owner = db.Column(db.String)
+    lease_expires_at = db.Column(db.DateTime)
+
+
+class PlaylistSyncJob(db.Model):
+    """
+    Table to store activity playlists waiting to be synced with Spotify. Each playlist has at most one job, so requests
+    made while a sync is pending are merged into it
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    activity_playlist_id = db.Column(db.Integer, db.ForeignKey('activity_playlist.id'), unique=True, nullable=False)
+    spotify_user_id = db.Column(db.String, nullable=False, index=True)
+    requested_at = db.Column(db.DateTime, nullable=False)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.String)
+    lease_owner = db.Column(db.String)
+    lease_expires_at = db.Column(db.DateTime)
+
+
+class DailyListeningStats(db.Model):
+    """
+    Table to store how many songs each user played on each day (UTC), kept up to date as history is saved
+    """
+    __table_args__ = (
+        db.UniqueConstraint('spotify_user_id', 'day'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    spotify_user_id = db.Column(db.String, nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    play_count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class ArtistListeningStats(db.Model):
+    """
+    Table to store how many songs by each artist each user played, kept up to date as history is saved
+    """
+    __table_args__ = (
+        db.UniqueConstraint('spotify_user_id', 'artist_name'),
+        db.Index('ix_artist_listening_stats_user_play_count', 'spotify_user_id', 'play_count'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    spotify_user_id = db.Column(db.String, nullable=False)
+    artist_name = db.Column(db.String, nullable=False)
+    play_count = db.Column(db.Integer, nullable=False, default=0)
+    last_played_at = db.Column(db.DateTime)
+
+
+class ActivityListeningStats(db.Model):
+    """
+    Table to store the listening sessions labeled with each activity, kept up to date as sessions are labeled
+    """
+    __table_args__ = (
+        db.UniqueConstraint('spotify_user_id', 'activity_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    spotify_user_id = db.Column(db.String, nullable=False)
+    activity_id = db.Column(db.Integer, db.ForeignKey('activity.id'), nullable=False)
+    session_count = db.Column(db.Integer, nullable=False, default=0)
+    play_count = db.Column(db.Integer, nullable=False, default=0)
+    listening_seconds = db.Column(db.Integer, nullable=False, default=0)
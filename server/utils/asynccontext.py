@@ -0,0 +1,20 @@
+import asyncio
+from typing import Callable
+
+from server import app
+
+
+async def run_in_app_context(func: Callable, *args, **kwargs):
+    """
+    Runs blocking work, such as database queries, in a worker thread so it doesn't hold up the event loop. The thread
+    gets its own app context, and with it its own database session, which is closed once `func` returns. Return plain
+    data, not database objects, since they can't be loaded from once the session is closed
+    @param func: Function to run
+    @param args: Passed through to `func`
+    @param kwargs: Passed through to `func`
+    @return: What `func` returns
+    """
+    def run():
+        with app.app_context():
+            return func(*args, **kwargs)
+    return await asyncio.to_thread(run)
@@ -0,0 +1,139 @@
+import asyncio
+import json
+import threading
+import weakref
+
+from server import app
+from server.utils.asynccontext import run_in_app_context
+from server.utils.ratelimiter import get_request_scheduler, get_request_priority, get_backoff_time
+from server.utils.spotifyapiutil import IDEMPOTENT_METHODS, get_access_token, get_authorization_header, \
+    get_cached_access_token, get_retry_after, refresh_tokens
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# Async counterparts of spotifyapiutil, used by the async views. Access tokens and the rate limiter are shared with the
+# sync client, so both count against the same Spotify limits. Database work (token lookups on a cache miss, refreshes)
+# is rare and reuses the sync code in a worker thread, see `run_in_app_context`.
+
+# event loop -> the aiohttp session used on it. Sessions are bound to the loop they were created on
+_http_sessions: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+_http_sessions_lock = threading.Lock()
+
+
+class AsyncSpotifyResponse:
+    """
+    A response from Spotify that has been read in full. Has the parts of requests.Response that are used on responses
+    """
+    def __init__(self, status_code: int, headers, content: bytes):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def get_async_http_session() -> 'aiohttp.ClientSession':
+    """
+    Returns the aiohttp session shared by every Spotify request made from the running event loop. Connections are kept
+    alive between requests, and up to `SPOTIFY_ASYNC_POOL_SIZE` requests can be in flight at once.
+    @return: The shared aiohttp.ClientSession
+    """
+    if aiohttp is None:
+        raise RuntimeError('The aiohttp package is required to serve the async views')
+    loop = asyncio.get_running_loop()
+    with _http_sessions_lock:
+        session = _http_sessions.get(loop)
+        if session is None:
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=app.config.get('SPOTIFY_ASYNC_POOL_SIZE')),
+                timeout=aiohttp.ClientTimeout(total=app.config.get('SPOTIFY_TIMEOUT_SECONDS'))
+            )
+            _http_sessions[loop] = session
+    return session
+
+
+async def spotify_request_async(request_type: str, url: str, auth: tuple[str, str] = None,
+                                **kwargs) -> AsyncSpotifyResponse:
+    """
+    Sends a request to Spotify through the running event loop's shared aiohttp session
+    @param request_type: HTTP method, such as 'GET' or 'POST'
+    @param url: url to make the request to (including params)
+    @param auth: Username and password for basic auth, if any
+    @param kwargs: Passed through to aiohttp.ClientSession.request
+    @return: The response, read in full
+    """
+    if auth is not None:
+        kwargs['auth'] = aiohttp.BasicAuth(*auth)
+    async with get_async_http_session().request(request_type, url, **kwargs) as res:
+        return AsyncSpotifyResponse(res.status, res.headers, await res.read())
+
+
+async def get_access_token_async(spotify_user_id: str) -> str:
+    """
+    Returns a user's access token. Cached tokens are returned right away, otherwise `get_access_token` reads or
+    refreshes the token in a worker thread
+    """
+    access_token = get_cached_access_token(spotify_user_id)
+    if access_token is not None:
+        return access_token
+    return await run_in_app_context(get_access_token, spotify_user_id)
+
+
+async def make_authorized_request_async(spotify_user_id: str, url: str, request_type: str = 'GET',
+                                        body: dict = None) -> dict:
+    """
+    Async version of `make_authorized_request`, with the same retries, token refresh and rate limiting
+
+    @param spotify_user_id: user to make request for
+    @param url: url to make the request to (including params)
+    @param request_type: Type of request to make. Valid types are 'GET', 'POST', 'PUT', and 'DELETE'
+    @param body: Body of request. Only used if `request_type` supports a message body
+    @return: HTTP response as dict
+    """
+    if request_type not in ('GET', 'POST', 'PUT', 'DELETE'):
+        raise ValueError(f'Unsupported request type: {request_type}')
+    scheduler = get_request_scheduler()
+    priority = get_request_priority()
+    max_retries = app.config.get('SPOTIFY_MAX_RETRIES')
+    access_token = await get_access_token_async(spotify_user_id)
+    token_refreshed = False
+    for attempt in range(max_retries + 1):
+        await scheduler.acquire_async(priority)
+        res = await spotify_request_async(request_type, url,
+                                          headers=get_authorization_header(spotify_user_id, access_token), json=body)
+        if res.status_code == 401 and not token_refreshed:
+            # "401 Unauthorized" likely means expired token, so try to get a new one
+            if not await run_in_app_context(refresh_tokens, spotify_user_id, access_token):
+                app.logger.error(f'Couldn\'t refresh token for user: {spotify_user_id}')
+                raise RuntimeError(f'Couldn\'t refresh token for user: {spotify_user_id}')
+            token_refreshed = True
+            access_token = await get_access_token_async(spotify_user_id)
+        elif res.status_code == 429 and attempt < max_retries:
+            # rate limited, hold back every request until Spotify says we can continue
+            retry_after = get_retry_after(res)
+            app.logger.warning(f'Rate limited by Spotify, pausing requests for {retry_after}s')
+            scheduler.pause(retry_after)
+        elif res.status_code >= 500 and request_type in IDEMPOTENT_METHODS and attempt < max_retries:
+            await asyncio.sleep(get_backoff_time(attempt))
+        else:
+            break
+
+    if res.status_code >= 400:
+        app.logger.error(f'Error making {request_type} request to: {url} for {spotify_user_id}')
+        app.logger.error(f'Status code {res.status_code}')
+        app.logger.error(f'headers: {res.headers}')
+        app.logger.error(f'Response: {res.text}')
+        raise RuntimeError(f'Error making request to: {url} for {spotify_user_id}')
+    try:
+        res_data = res.json()
+    except ValueError:
+        res_data = None
+    return res_data
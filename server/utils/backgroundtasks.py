@@ -1,12 +1,92 @@
-from apscheduler.schedulers.background import BackgroundScheduler
+import os
+import socket
+import time
+from datetime import datetime
 
-from server.database.historytracker import save_all_user_recently_played
+from sqlalchemy.exc import SQLAlchemyError
 
+from server import app, db
+from server.database.historyarchive import archive_song_history
+from server.database.historytracker import poll_users
+from server.database.playlistqueue import process_playlist_sync_jobs, get_next_playlist_sync_time
+from server.database.pollqueue import ensure_all_poll_jobs, claim_due_poll_jobs, complete_poll_jobs, \
+    get_next_poll_time
 
-def start_scheduler():
+# how long a worker waits before trying again when it can't claim or release jobs
+ERROR_RETRY_SECONDS = 5
+
+
+def run_poll_worker(once: bool = False) -> None:
     """
-    Starts running the background tasks to check for new songs in users' listening history every 30 minutes
+    Runs a worker that polls users' listening history as their poll jobs come due, and syncs activity playlists that
+    are waiting to be updated on Spotify. Jobs are stored in the database and
+    leased to one worker at a time, so any number of workers can run side by side and each user is still polled once
+    per interval. Each user's interval adapts to how much they listen, see `plan_next_poll`. Listening history older
+    than HISTORY_HOT_MONTHS is archived every HISTORY_ARCHIVE_INTERVAL_HOURS, see `archive_song_history`.
+    @param once: If `True`, return once there are no more due jobs instead of waiting for more
     """
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(func=save_all_user_recently_played, trigger='interval', minutes=30)
-    scheduler.start()
+    worker_id = f'{socket.gethostname()}-{os.getpid()}'
+    batch_size = app.config.get('POLL_BATCH_SIZE')
+    lease_seconds = app.config.get('POLL_LEASE_SECONDS')
+    default_interval_seconds = app.config.get('POLL_INTERVAL_MINUTES') * 60
+    max_idle_seconds = app.config.get('POLL_WORKER_IDLE_SECONDS')
+    archive_interval_seconds = app.config.get('HISTORY_ARCHIVE_INTERVAL_HOURS') * 3600
+    last_archived = None
+    # users whose poll finished but whose jobs couldn't be released yet, and the results of the poll
+    unreleased_poll = None
+
+    with app.app_context():
+        app.logger.info(f'Starting poll worker {worker_id}')
+        while True:
+            if last_archived is None or time.monotonic() - last_archived >= archive_interval_seconds:
+                try:
+                    archive_song_history()
+                except SQLAlchemyError:
+                    # e.g. another worker archiving the same month at the same time. Retried next interval
+                    db.session.rollback()
+                    app.logger.exception('Failed to archive listening history')
+                last_archived = time.monotonic()
+
+            try:
+                if unreleased_poll is not None:
+                    # the last poll finished but releasing its jobs failed, so release them before claiming more
+                    complete_poll_jobs(worker_id, *unreleased_poll)
+                    unreleased_poll = None
+
+                # playlist syncs were requested by users, so they go before polling
+                playlists_synced = process_playlist_sync_jobs(worker_id, batch_size, lease_seconds)
+
+                # pick up users that don't have a job yet, e.g. from before poll jobs existed
+                ensure_all_poll_jobs(spread_seconds=default_interval_seconds)
+                spotify_user_ids = claim_due_poll_jobs(worker_id, batch_size, lease_seconds)
+            except SQLAlchemyError:
+                # e.g. the database is locked by another worker. Tried again after a short wait
+                db.session.rollback()
+                app.logger.exception('Failed to claim jobs')
+                time.sleep(ERROR_RETRY_SECONDS)
+                continue
+
+            if spotify_user_ids:
+                stats = poll_users(spotify_user_ids)
+                app.logger.info(
+                    'Polled %d users in %.1fs (%d failures, %d songs saved)',
+                    stats['users_polled'], stats['wall_time_seconds'], stats['failures'], stats['songs_saved']
+                )
+                try:
+                    complete_poll_jobs(worker_id, spotify_user_ids, stats['new_plays'])
+                except SQLAlchemyError:
+                    db.session.rollback()
+                    app.logger.exception('Failed to release poll jobs')
+                    unreleased_poll = (spotify_user_ids, stats['new_plays'])
+                continue
+            if playlists_synced:
+                continue
+
+            if once:
+                return
+            idle_seconds = max_idle_seconds
+            for next_job_time in (get_next_poll_time(), get_next_playlist_sync_time()):
+                if next_job_time is not None:
+                    seconds_until_due = max((next_job_time - datetime.utcnow()).total_seconds(), 1)
+                    idle_seconds = min(idle_seconds, seconds_until_due)
+            time.sleep(idle_seconds)
@@ -1,42 +1,59 @@
 from datetime import datetime
 
-from server.database.datamanager import get_user_listening_history, save_listening_session,\
-    get_latest_listening_session, get_user_listening_history_after_date
+from server import app, db
+from server.database.datamanager import save_listening_session, get_latest_listening_session, \
+    iter_user_played_at_after
+from server.database.syncstate import get_or_create_sync_state
+from server.models import UserSyncState
+
+
+def get_listening_session_cursor(spotify_user_id: str) -> UserSyncState:
+    """
+    Gets the sync state holding a user's listening session cursor. Users whose cursor was never set start after their
+    latest listening session, if they have one.
+    @param spotify_user_id: The user to get the cursor for
+    @return: The UserSyncState object
+    """
+    sync_state = get_or_create_sync_state(spotify_user_id)
+    if sync_state.session_last_played_at is None:
+        latest_listening_session = get_latest_listening_session(spotify_user_id)
+        if latest_listening_session:
+            sync_state.session_last_played_at = latest_listening_session.end_time
+    return sync_state
+
+
+def close_open_session(cursor: UserSyncState) -> None:
+    """
+    Ends the cursor's open session, saving it as a listening session if it has enough songs
+    """
+    if cursor.open_session_song_count >= app.config.get('SESSION_MIN_SONGS'):
+        save_listening_session(cursor.spotify_user_id, cursor.open_session_start, cursor.session_last_played_at,
+                               commit=False)
+    cursor.open_session_start = None
+    cursor.open_session_song_count = 0
 
 
 def create_listening_sessions(spotify_user_id: str) -> None:
     """
-    Goes through the user's listening history, creating new unlabeled listening sessions
+    Goes through the user's new listening history, creating new unlabeled listening sessions. Only songs saved since
+    the last call are read, and the session still in progress is carried over in the user's UserSyncState.
     @param spotify_user_id: The id of the user to create listening sessions for
     """
-    latest_listening_session = get_latest_listening_session(spotify_user_id)
-    if latest_listening_session is None:
-        history = get_user_listening_history(spotify_user_id)
-    else:
-        history = get_user_listening_history_after_date(spotify_user_id, latest_listening_session.end_time)
-    history.reverse()
-
-    if len(history) == 0:
-        return
-
-    min_songs = 3
-    start_time: datetime = history[0].played_at
-    start_index = 0
-    previous_played_at: datetime = history[0].played_at
-
-    for i in range(len(history)):
-        current_played_at: datetime = history[i].played_at
-        time_difference = current_played_at - previous_played_at
-
-        if time_difference.total_seconds() >= 1800:
-            if i - start_index >= min_songs:
-                # only create a listening session if there are more than min_songs songs
-                save_listening_session(spotify_user_id, start_time, previous_played_at)
-            start_time = current_played_at
-            start_index = i
-
-        if i == len(history) - 1:
-            if (datetime.now() - current_played_at).total_seconds() >= 1800 and i - start_index >= min_songs:
-                save_listening_session(spotify_user_id, start_time, current_played_at)
-
-        previous_played_at = current_played_at
+    cursor = get_listening_session_cursor(spotify_user_id)
+    session_gap = app.config.get('SESSION_GAP_SECONDS')
+
+    for played_at in iter_user_played_at_after(spotify_user_id, cursor.session_last_played_at):
+        if cursor.open_session_song_count and \
+                (played_at - cursor.session_last_played_at).total_seconds() >= session_gap:
+            close_open_session(cursor)
+        if not cursor.open_session_song_count:
+            cursor.open_session_start = played_at
+        cursor.open_session_song_count += 1
+        cursor.session_last_played_at = played_at
+
+    # the open session is over once no new song could be close enough to join it
+    if cursor.open_session_song_count and \
+            (datetime.utcnow() - cursor.session_last_played_at).total_seconds() >= session_gap:
+        close_open_session(cursor)
+
+    db.session.commit()
@@ -0,0 +1,51 @@
+import random
+from datetime import datetime, timedelta
+
+from server import app
+from server.models import PollJob
+
+# Spotify's recently played endpoint returns at most this many songs, so anything older is lost between polls
+RECENTLY_PLAYED_LIMIT = 50
+
+
+def plan_next_poll(job: PollJob, new_plays: int | None, now: datetime) -> tuple[datetime, float | None, int]:
+    """
+    Decides when a user should next be polled, based on how fast they have been listening to music. Heavy listeners
+    are polled just often enough that fewer than `POLL_TARGET_PLAYS` songs pile up between polls, while users who
+    haven't played anything are backed off up to `POLL_MAX_INTERVAL_MINUTES`. Jitter is added so jobs that started
+    together drift apart instead of all coming due at once.
+    @param job: The user's poll job, before this poll's results are recorded
+    @param new_plays: The number of songs found by this poll, or None if the poll failed
+    @param now: The time of this poll
+    @return: (next run time, updated play rate in plays per hour, interval in seconds before jitter)
+    """
+    min_interval = app.config.get('POLL_MIN_INTERVAL_MINUTES') * 60
+    max_interval = app.config.get('POLL_MAX_INTERVAL_MINUTES') * 60
+    previous_interval = job.poll_interval_seconds or app.config.get('POLL_INTERVAL_MINUTES') * 60
+    play_rate = job.play_rate
+
+    if new_plays is None:
+        # nothing was learned, try again on the same schedule
+        interval = previous_interval
+    else:
+        if job.last_run_at is not None:
+            elapsed_hours = max((now - job.last_run_at).total_seconds() / 3600, 1 / 60)
+            observed_rate = new_plays / elapsed_hours
+            smoothing = app.config.get('POLL_RATE_SMOOTHING')
+            play_rate = observed_rate if play_rate is None else \
+                smoothing * observed_rate + (1 - smoothing) * play_rate
+            if new_plays >= RECENTLY_PLAYED_LIMIT:
+                # some plays were probably missed, so the real rate is at least what was observed
+                play_rate = max(play_rate, observed_rate)
+
+        if play_rate:
+            interval = app.config.get('POLL_TARGET_PLAYS') / play_rate * 3600
+        else:
+            interval = previous_interval
+        if new_plays == 0:
+            interval = max(interval, previous_interval * app.config.get('POLL_BACKOFF_FACTOR'))
+
+    interval = int(min(max(interval, min_interval), max_interval))
+    jitter = app.config.get('POLL_JITTER')
+    next_run_at = now + timedelta(seconds=interval * random.uniform(1 - jitter, 1 + jitter))
+    return next_run_at, play_rate, interval
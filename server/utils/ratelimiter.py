@@ -0,0 +1,135 @@
+import asyncio
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from server import app
+
+# request priority lanes. Lower numbers are served first
+INTERACTIVE = 0
+BACKGROUND = 1
+
+_request_priority: ContextVar[int] = ContextVar('spotify_request_priority', default=INTERACTIVE)
+
+
+@contextmanager
+def request_priority(priority: int):
+    """
+    Sets the priority lane used for Spotify requests made inside this block
+    @param priority: INTERACTIVE or BACKGROUND
+    """
+    token = _request_priority.set(priority)
+    try:
+        yield
+    finally:
+        _request_priority.reset(token)
+
+
+def get_request_priority() -> int:
+    return _request_priority.get()
+
+
+class RequestScheduler:
+    """
+    Token bucket shared by every Spotify request in this process. Requests wait for a token before being sent, waiting
+    interactive requests are always let through before background ones, and a 429 response pauses every lane until
+    Spotify's `Retry-After` has passed.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.waiting = [0, 0]
+        self.condition = threading.Condition()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def _take_token(self, priority: int) -> float:
+        """
+        Takes a token if a request in the given priority lane may be sent now. Must be called holding `condition`
+        @return: 0 if a token was taken, otherwise how long to wait before trying again
+        """
+        now = time.monotonic()
+        self._refill(now)
+        higher_priority_waiting = any(self.waiting[p] for p in range(priority))
+        if now >= self.paused_until and self.tokens >= 1 and not higher_priority_waiting:
+            self.tokens -= 1
+            return 0
+        return max(self.paused_until - now, (1 - self.tokens) / self.rate, 0.01)
+
+    def acquire(self, priority: int = INTERACTIVE) -> None:
+        """
+        Blocks until a request in the given priority lane may be sent
+        @param priority: INTERACTIVE or BACKGROUND
+        """
+        with self.condition:
+            self.waiting[priority] += 1
+            try:
+                while wait_time := self._take_token(priority):
+                    self.condition.wait(timeout=wait_time)
+            finally:
+                self.waiting[priority] -= 1
+                self.condition.notify_all()
+
+    async def acquire_async(self, priority: int = INTERACTIVE) -> None:
+        """
+        Like `acquire`, but waits without blocking the event loop
+        @param priority: INTERACTIVE or BACKGROUND
+        """
+        with self.condition:
+            self.waiting[priority] += 1
+        try:
+            while True:
+                with self.condition:
+                    wait_time = self._take_token(priority)
+                if not wait_time:
+                    return
+                await asyncio.sleep(wait_time)
+        finally:
+            with self.condition:
+                self.waiting[priority] -= 1
+                self.condition.notify_all()
+
+    def pause(self, seconds: float) -> None:
+        """
+        Stops all requests from being sent for a number of seconds, e.g. after Spotify responds with 429
+        @param seconds: How long to pause for
+        """
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+
+
+_scheduler: RequestScheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_request_scheduler() -> RequestScheduler:
+    """
+    Returns the request scheduler shared by this process, creating it from the app config on first use
+    """
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = RequestScheduler(
+                    rate=app.config.get('SPOTIFY_RATE_LIMIT_PER_SECOND'),
+                    capacity=app.config.get('SPOTIFY_RATE_LIMIT_BURST')
+                )
+    return _scheduler
+
+
+def get_backoff_time(attempt: int) -> float:
+    """
+    Exponential backoff with full jitter for retrying failed requests
+    @param attempt: How many attempts have already been made, starting from 0
+    @return: Seconds to wait before the next attempt
+    """
+    return random.uniform(0, app.config.get('SPOTIFY_BACKOFF_BASE_SECONDS') * 2 ** attempt)
@@ -0,0 +1,203 @@
+from bisect import bisect_right
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import insert, select, delete, update, bindparam, union, union_all, Table
+
+from server import app, db
+from server.database.historyarchive import get_history_tables, get_archive_month, add_months
+from server.database.statsmanager import rebuild_activity_stats
+from server.database.syncstate import ensure_sync_states
+from server.models import SongHistoryRecord, ListeningSession, UserSyncState
+from server.utils.responsecache import invalidate_user_cache
+
+
+def find_sessions(spotify_user_ids: np.ndarray, played_at: np.ndarray, gap_seconds: int, min_songs: int,
+                  now: np.datetime64) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Splits the listening history of many users into listening sessions at once. The history must be sorted by user,
+    then by played_at.
+    @param spotify_user_ids: The user of each song
+    @param played_at: The played_at time of each song, as datetime64
+    @param gap_seconds: Songs this far apart or more are in different sessions
+    @param min_songs: Sessions with fewer songs than this are dropped
+    @param now: The current time. Each user's last run of songs is only a session if it ended at least `gap_seconds`
+    before now, otherwise it is still in progress
+    @return: (start index, end index) of every session, and (start index, end index) of each user's last run of songs
+    """
+    song_count = len(played_at)
+    gap = np.timedelta64(gap_seconds, 's')
+    # a run of songs ends wherever the next song is too far away, or belongs to a different user
+    user_changes = spotify_user_ids[1:] != spotify_user_ids[:-1]
+    boundaries = (np.diff(played_at) >= gap) | user_changes
+    run_starts = np.concatenate(([0], np.flatnonzero(boundaries) + 1))
+    run_ends = np.concatenate((np.flatnonzero(boundaries), [song_count - 1]))
+
+    # the final run of each user may still be in progress
+    is_last_run = np.concatenate((user_changes[run_ends[:-1]], [True]))
+    in_progress = is_last_run & (now - played_at[run_ends] < gap)
+
+    is_session = (run_ends - run_starts + 1 >= min_songs) & ~in_progress
+    return run_starts[is_session], run_ends[is_session], run_starts[is_last_run], run_ends[is_last_run]
+
+
+def resessionize_users(spotify_user_ids: list[str], gap_seconds: int, min_songs: int) -> int:
+    """
+    Rebuilds the listening sessions of a batch of users from their full listening history, and relinks their songs to
+    the new sessions. Activity labels are kept: each new session takes the activity of the first labeled old session it
+    overlaps. The users' session cursors are reset to match, so incremental segmentation carries on from the rebuilt
+    sessions.
+    @param spotify_user_ids: The users to rebuild sessions for
+    @param gap_seconds: Songs this far apart or more are in different sessions
+    @param min_songs: Sessions with fewer songs than this are dropped
+    @return: The number of sessions created
+    """
+    history_tables = get_history_tables()
+    rows = db.session.execute(
+        union_all(*[
+            select(table.c.spotify_user_id, table.c.played_at).where(table.c.spotify_user_id.in_(spotify_user_ids))
+            for table in history_tables
+        ]).order_by('spotify_user_id', 'played_at')
+    ).all()
+
+    # old labeled sessions, by user, as sorted lists of (start_time, end_time, activity_id)
+    labeled_sessions: dict[str, list[tuple[datetime, datetime, int]]] = {}
+    for suid, start_time, end_time, activity_id in db.session.execute(
+        select(ListeningSession.spotify_user_id, ListeningSession.start_time, ListeningSession.end_time,
+               ListeningSession.activity_id)
+        .where(ListeningSession.spotify_user_id.in_(spotify_user_ids))
+        .where(ListeningSession.activity_id.isnot(None))
+        .order_by(ListeningSession.start_time)
+    ):
+        labeled_sessions.setdefault(suid, []).append((start_time, end_time, activity_id))
+
+    new_sessions = []
+    new_cursors = []
+    if rows:
+        users = np.array([row[0] for row in rows], dtype=object)
+        played_at = np.array([row[1] for row in rows], dtype='datetime64[us]')
+        now = np.datetime64(datetime.utcnow(), 'us')
+        starts, ends, last_starts, last_ends = find_sessions(users, played_at, gap_seconds, min_songs, now)
+
+        start_times = played_at[starts].tolist()
+        end_times = played_at[ends].tolist()
+        # labels are looked up per new session, so when an old session is split, every part keeps its label, and when
+        # several are merged, the new session takes the earliest one's label
+        for suid, start_time, end_time in zip(users[starts], start_times, end_times):
+            new_sessions.append({
+                'spotify_user_id': suid,
+                'start_time': start_time,
+                'end_time': end_time,
+                'activity_id': find_overlapping_activity(labeled_sessions.get(suid, []), start_time, end_time)
+            })
+
+        for suid, last_start, last_end in zip(users[last_ends], last_starts, last_ends):
+            in_progress = now - played_at[last_end] < np.timedelta64(gap_seconds, 's')
+            new_cursors.append({
+                'b_spotify_user_id': suid,
+                'b_session_last_played_at': played_at[last_end].tolist(),
+                'b_open_session_start': played_at[last_start].tolist() if in_progress else None,
+                'b_open_session_song_count': int(last_end - last_start + 1) if in_progress else 0
+            })
+
+    for table in history_tables:
+        db.session.execute(
+            update(table).where(table.c.spotify_user_id.in_(spotify_user_ids)).values(session_id=None)
+        )
+    db.session.execute(delete(ListeningSession).where(ListeningSession.spotify_user_id.in_(spotify_user_ids)))
+    db.session.execute(
+        update(UserSyncState).where(UserSyncState.spotify_user_id.in_(spotify_user_ids))
+        .values(session_last_played_at=None, open_session_start=None, open_session_song_count=0)
+    )
+    if new_sessions:
+        db.session.execute(insert(ListeningSession), new_sessions)
+        assign_songs_to_listening_sessions(spotify_user_ids, history_tables)
+    if new_cursors:
+        ensure_sync_states([cursor['b_spotify_user_id'] for cursor in new_cursors])
+        db.session.connection().execute(
+            update(UserSyncState)
+            .where(UserSyncState.spotify_user_id == bindparam('b_spotify_user_id'))
+            .values(
+                session_last_played_at=bindparam('b_session_last_played_at'),
+                open_session_start=bindparam('b_open_session_start'),
+                open_session_song_count=bindparam('b_open_session_song_count')
+            ),
+            new_cursors
+        )
+    # session boundaries may have moved, changing how many songs each activity has
+    rebuild_activity_stats(spotify_user_ids)
+    db.session.commit()
+    for spotify_user_id in spotify_user_ids:
+        invalidate_user_cache(spotify_user_id, 'sessions')
+    return len(new_sessions)
+
+
+def assign_songs_to_listening_sessions(spotify_user_ids: list[str], history_tables: list[Table] = None) -> None:
+    """
+    Links the songs of a batch of users to their listening sessions, with one executemany UPDATE per history table
+    @param spotify_user_ids: The users whose songs should be linked
+    @param history_tables: The tables holding their songs. Defaults to the hot table and every archive table
+    """
+    sessions = db.session.execute(
+        select(ListeningSession.id, ListeningSession.spotify_user_id, ListeningSession.start_time,
+               ListeningSession.end_time)
+        .where(ListeningSession.spotify_user_id.in_(spotify_user_ids))
+    ).all()
+    for song_table in history_tables or get_history_tables():
+        table_sessions = sessions
+        if song_table is not SongHistoryRecord.__table__:
+            # an archive table only holds one month, so skip the sessions outside it
+            month_start = get_archive_month(song_table)
+            month_end = add_months(month_start, 1)
+            table_sessions = [s for s in sessions if s.start_time < month_end and s.end_time >= month_start]
+        if not table_sessions:
+            continue
+        db.session.connection().execute(
+            song_table.update()
+            .where(song_table.c.spotify_user_id == bindparam('b_spotify_user_id'))
+            .where(song_table.c.played_at >= bindparam('b_start_time'))
+            .where(song_table.c.played_at <= bindparam('b_end_time'))
+            .values(session_id=bindparam('b_session_id')),
+            [{
+                'b_session_id': session_id,
+                'b_spotify_user_id': suid,
+                'b_start_time': start_time,
+                'b_end_time': end_time
+            } for session_id, suid, start_time, end_time in table_sessions]
+        )
+
+
+def find_overlapping_activity(labeled_sessions: list[tuple[datetime, datetime, int]], start_time: datetime,
+                              end_time: datetime) -> int | None:
+    """
+    @param labeled_sessions: A user's labeled sessions, as (start_time, end_time, activity_id) sorted by start_time
+    @param start_time: Start of the new session
+    @param end_time: End of the new session
+    @return: The activity of the first labeled session overlapping the new session, or None
+    """
+    # sessions don't overlap each other, so only the session starting just before start_time, and the ones starting
+    # during the new session, can overlap it
+    i = max(bisect_right(labeled_sessions, (start_time,)) - 1, 0)
+    for old_start, old_end, activity_id in labeled_sessions[i:]:
+        if old_start > end_time:
+            break
+        if old_end >= start_time:
+            return activity_id
+    return None
+
+
+def resessionize_all_users(gap_seconds: int, min_songs: int, batch_size: int) -> int:
+    """
+    Rebuilds the listening sessions of every user with listening history, `batch_size` users at a time
+    @return: The number of sessions created
+    """
+    # union removes duplicates, so users with songs in several tables are listed once
+    spotify_user_ids = [suid for suid, in db.session.execute(
+        union(*[select(table.c.spotify_user_id) for table in get_history_tables()]).order_by('spotify_user_id')
+    )]
+    created = 0
+    for i in range(0, len(spotify_user_ids), batch_size):
+        created += resessionize_users(spotify_user_ids[i:i + batch_size], gap_seconds, min_songs)
+        done = min(i + batch_size, len(spotify_user_ids))
+        app.logger.info(f'Rebuilt sessions for {done}/{len(spotify_user_ids)} users')
+    return created
@@ -0,0 +1,157 @@
+import hashlib
+import threading
+import time
+from functools import wraps
+from typing import Callable
+
+from flask import request, Response
+from flask_jwt_extended import get_jwt_identity
+
+from server import app, db
+from server.database.sessionhooks import run_after_transaction
+from server.utils.lrucache import LRUCache
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class MemoryCacheBackend:
+    """
+    Response cache kept in this process. Invalidations made by other processes, like poll workers, aren't seen here,
+    so cached responses may be up to the TTL out of date
+    """
+
+    def __init__(self, maxsize: int, ttl_seconds: int):
+        self.ttl_seconds = ttl_seconds
+        self.responses = LRUCache(maxsize)
+        # never evicted: losing a generation would bring back responses that were invalidated
+        self.generations: dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> bytes | None:
+        entry = self.responses.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def set(self, key: str, body: bytes) -> None:
+        self.responses.put(key, (time.monotonic() + self.ttl_seconds, body))
+
+    def get_generations(self, keys: list[str]) -> list[int]:
+        return [self.generations.get(key, 0) for key in keys]
+
+    def increment_generation(self, key: str) -> None:
+        with self.lock:
+            self.generations[key] = self.generations.get(key, 0) + 1
+
+
+class RedisCacheBackend:
+    """
+    Response cache stored in Redis (or a Redis-compatible server), shared by every process
+    """
+
+    def __init__(self, url: str, ttl_seconds: int):
+        if redis is None:
+            raise RuntimeError('The redis package is required to use RESPONSE_CACHE_URL')
+        self.ttl_seconds = ttl_seconds
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key: str) -> bytes | None:
+        return self.client.get(f'response:{key}')
+
+    def set(self, key: str, body: bytes) -> None:
+        self.client.set(f'response:{key}', body, ex=self.ttl_seconds)
+
+    def get_generations(self, keys: list[str]) -> list[int]:
+        return [int(generation or 0) for generation in self.client.mget([f'generation:{key}' for key in keys])]
+
+    def increment_generation(self, key: str) -> None:
+        self.client.incr(f'generation:{key}')
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_cache_backend():
+    """
+    Returns the response cache backend, creating it from the app config on first use. Responses are stored in Redis if
+    `RESPONSE_CACHE_URL` is set, and in memory otherwise
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                ttl_seconds = app.config.get('RESPONSE_CACHE_TTL_SECONDS')
+                if app.config.get('RESPONSE_CACHE_URL'):
+                    _backend = RedisCacheBackend(app.config.get('RESPONSE_CACHE_URL'), ttl_seconds)
+                else:
+                    _backend = MemoryCacheBackend(app.config.get('RESPONSE_CACHE_SIZE'), ttl_seconds)
+    return _backend
+
+
+def invalidate_user_cache(spotify_user_id: str, *groups: str) -> None:
+    """
+    Invalidates a user's cached responses that depend on any of the given groups of data. If the database session is in
+    a transaction, the groups are invalidated once it ends. Otherwise a request could cache the old data again before
+    the changes are committed
+    @param spotify_user_id: The user whose data changed
+    @param groups: The groups of data that changed, e.g. 'activities' or 'sessions'
+    """
+    if not app.config.get('RESPONSE_CACHE_ENABLED'):
+        return
+
+    def increment_generations():
+        backend = get_cache_backend()
+        for group in groups:
+            backend.increment_generation(f'{spotify_user_id}:{group}')
+    if db.session().in_transaction():
+        run_after_transaction(increment_generations)
+    else:
+        increment_generations()
+
+
+def cached_response(spotify_user_id: str, groups: list[str], build_response: Callable) -> Response:
+    """
+    Returns the cached response for the current request if there is one, otherwise builds and caches it. Responses are
+    cached per user and url, and stay valid until any of their groups are invalidated with `invalidate_user_cache` or
+    `RESPONSE_CACHE_TTL_SECONDS` passes. Each response has an ETag, so clients can revalidate with If-None-Match and
+    receive 304 Not Modified instead of the body.
+    @param spotify_user_id: The user making the request
+    @param groups: The groups of data this response is built from
+    @param build_response: Builds the response on a cache miss. Returns anything a view function can return
+    @return: The response
+    """
+    if not app.config.get('RESPONSE_CACHE_ENABLED'):
+        return app.make_response(build_response())
+
+    backend = get_cache_backend()
+    generations = backend.get_generations([f'{spotify_user_id}:{group}' for group in groups])
+    key = f'{spotify_user_id}:{request.full_path}:' + '.'.join(str(generation) for generation in generations)
+
+    body = backend.get(key)
+    if body is None:
+        response = app.make_response(build_response())
+        if response.status_code != 200:
+            return response
+        body = response.get_data()
+        backend.set(key, body)
+
+    response = Response(body, mimetype='application/json')
+    response.set_etag(hashlib.sha1(body).hexdigest())
+    return response.make_conditional(request)
+
+
+def cache_response(*groups: str):
+    """
+    Decorator for views whose response only depends on the current user's data in the given groups. Must be placed
+    under `jwt_required`. See `cached_response`
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            return cached_response(get_jwt_identity(), list(groups), lambda: view(*args, **kwargs))
+        return wrapper
+    return decorator
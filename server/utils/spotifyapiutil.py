@@ -1,50 +1,195 @@
-import json
+import threading
+import time
+from datetime import datetime, timedelta
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from server import endpoints, app, db
 from server.models import SpotifyToken
+from server.utils.ratelimiter import get_request_scheduler, get_request_priority, get_backoff_time
 
+_http_session: requests.Session = None
+_http_session_lock = threading.Lock()
 
-def refresh_tokens(spotify_user_id: str) -> bool:
+# spotify_user_id -> (access_token, expires_at). expires_at is in UTC, or None if the expiry isn't known
+_token_cache: dict[str, tuple[str, datetime | None]] = {}
+_token_cache_lock = threading.Lock()
+_refresh_locks: dict[str, threading.Lock] = {}
+
+# methods that are safe to send again after a server error. Spotify may have applied a POST before failing, and sending
+# it again would, for example, add the same tracks to a playlist twice
+IDEMPOTENT_METHODS = ('GET', 'PUT', 'DELETE')
+
+
+def get_http_session() -> requests.Session:
+    """
+    Returns the HTTP session shared by every Spotify request in this process. Reusing it keeps connections to Spotify
+    alive between requests instead of paying for a new TCP and TLS handshake each time.
+    @return: The shared requests.Session
+    """
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=app.config.get('SPOTIFY_POOL_SIZE'))
+                session.mount('https://', adapter)
+                session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+                _http_session = session
+    return _http_session
+
+
+def spotify_request(request_type: str, url: str, **kwargs) -> requests.Response:
+    """
+    Sends a request to Spotify through the shared HTTP session, applying the configured timeout
+    @param request_type: HTTP method, such as 'GET' or 'POST'
+    @param url: url to make the request to (including params)
+    @param kwargs: Passed through to requests.Session.request
+    @return: The requests.Response
+    """
+    kwargs.setdefault('timeout', app.config.get('SPOTIFY_TIMEOUT_SECONDS'))
+    return get_http_session().request(request_type, url, **kwargs)
+
+
+def get_token_expiry(expires_in: int | None) -> datetime | None:
+    """
+    Works out when an access token expires from the `expires_in` of Spotify's token response
+    @param expires_in: Seconds until the token expires. `None` if unknown
+    @return: When the token expires, in UTC, or `None` if unknown
+    """
+    return datetime.utcnow() + timedelta(seconds=expires_in) if expires_in is not None else None
+
+
+def cache_access_token(spotify_user_id: str, access_token: str, expires_at: datetime = None) -> None:
+    """
+    Stores an access token in the in-memory token cache.
+
+    @param spotify_user_id: The user the token belongs to
+    @param access_token: The Spotify access token
+    @param expires_at: When the token expires, in UTC, as saved on the SpotifyToken. `None` if unknown
+    """
+    with _token_cache_lock:
+        _token_cache[spotify_user_id] = (access_token, expires_at)
+
+
+def is_token_expiring(expires_at: datetime | None) -> bool:
+    """
+    Whether an access token expires within `SPOTIFY_TOKEN_REFRESH_MARGIN_SECONDS`, and so should be refreshed before
+    it's used. Tokens with an unknown expiry are used until Spotify rejects them
+    """
+    refresh_margin = app.config.get('SPOTIFY_TOKEN_REFRESH_MARGIN_SECONDS')
+    return expires_at is not None and (expires_at - datetime.utcnow()).total_seconds() <= refresh_margin
+
+
+def get_refresh_lock(spotify_user_id: str) -> threading.Lock:
+    """
+    Returns the lock that serializes token refreshes for a user, so concurrent requests only refresh once
+    """
+    with _token_cache_lock:
+        return _refresh_locks.setdefault(spotify_user_id, threading.Lock())
+
+
+def refresh_tokens(spotify_user_id: str, stale_access_token: str = None) -> bool:
     """
     Refreshes the access_token for a user.
 
     @param spotify_user_id: The user to refresh the token for
+    @param stale_access_token: The token the caller found to be expired. If another thread has already replaced it by
+    the time the refresh lock is acquired, no new refresh is made
     @return: `True` if the token was successfully refreshed, `False` otherwise
     """
-    # get refresh token
-    st = SpotifyToken.query.filter_by(spotify_user_id=spotify_user_id).first()
-
-    # construct and make request
-    headers = {
-        'grant_type': 'refresh_token',
-        'refresh_token': st.refresh_token
-    }
-    res = requests.post(
-        endpoints.TOKEN_URL,
-        auth=(app.config.get('CLIENT_ID'), app.config.get('CLIENT_SECRET')),
-        data=headers
-    )
-    res_data = res.json()
-
-    # error checking
-    if res.status_code != 200:
-        app.logger.error(
-            'Failed to refresh tokens: %s',
-            res_data.get('error', 'No error information provided.')
+    with get_refresh_lock(spotify_user_id):
+        cached = _token_cache.get(spotify_user_id)
+        if stale_access_token is not None and cached is not None and cached[0] != stale_access_token:
+            # someone else refreshed the token while we were waiting for the lock
+            return True
+
+        # get refresh token
+        st = SpotifyToken.query.filter_by(spotify_user_id=spotify_user_id).first()
+
+        # construct and make request
+        headers = {
+            'grant_type': 'refresh_token',
+            'refresh_token': st.refresh_token
+        }
+        res = spotify_request(
+            'POST',
+            endpoints.TOKEN_URL,
+            auth=(app.config.get('CLIENT_ID'), app.config.get('CLIENT_SECRET')),
+            data=headers
         )
-        return False
+        res_data = res.json()
+
+        # error checking
+        if res.status_code != 200:
+            app.logger.error(
+                'Failed to refresh tokens: %s',
+                res_data.get('error', 'No error information provided.')
+            )
+            return False
+
+        # save new access token to db. Spotify may also rotate the refresh token
+        st.access_token = res_data.get('access_token')
+        st.expires_at = get_token_expiry(res_data.get('expires_in'))
+        if res_data.get('refresh_token'):
+            st.refresh_token = res_data.get('refresh_token')
+        db.session.commit()
+        cache_access_token(spotify_user_id, st.access_token, st.expires_at)
+        return True
+
+
+def get_access_token(spotify_user_id: str) -> str:
+    """
+    Returns a user's access token from the token cache, only reading the database on a cache miss. Tokens that are
+    about to expire are refreshed before they are returned.
 
-    # save new access token to db
-    st.access_token = res_data.get('access_token')
-    db.session.commit()
-    return True
+    @param spotify_user_id: The user to get the token for
+    @return: The access token
+    """
+    cached = _token_cache.get(spotify_user_id)
+    if cached is None:
+        st = SpotifyToken.query.filter_by(spotify_user_id=spotify_user_id).first()
+        cache_access_token(spotify_user_id, st.access_token, st.expires_at)
+        cached = (st.access_token, st.expires_at)
+
+    access_token, expires_at = cached
+    if is_token_expiring(expires_at):
+        if refresh_tokens(spotify_user_id, access_token):
+            access_token = _token_cache[spotify_user_id][0]
+    return access_token
+
+
+def get_cached_access_token(spotify_user_id: str) -> str | None:
+    """
+    Returns a user's access token if it's in the token cache and isn't about to expire, without reading the database
+    or refreshing it
+    """
+    cached = _token_cache.get(spotify_user_id)
+    if cached is None:
+        return None
+    access_token, expires_at = cached
+    if is_token_expiring(expires_at):
+        return None
+    return access_token
 
 
-def get_authorization_header(spotify_user_id: str):
-    st = SpotifyToken.query.filter_by(spotify_user_id=spotify_user_id).first()
-    return {'Authorization': f'Bearer {st.access_token if st.access_token is not None else None}'}
+def get_authorization_header(spotify_user_id: str, access_token: str = None):
+    if access_token is None:
+        access_token = get_access_token(spotify_user_id)
+    return {'Authorization': f'Bearer {access_token}'}
+
+
+def get_retry_after(res: requests.Response) -> float:
+    """
+    Reads the number of seconds to wait from a 429 response's `Retry-After` header
+    @param res: The 429 response
+    @return: Seconds to wait, defaulting to 1 if the header is missing or not a number
+    """
+    try:
+        return max(float(res.headers.get('Retry-After', 1)), 0.0)
+    except ValueError:
+        return 1.0
 
 
 def make_authorized_request(spotify_user_id: str, url: str, request_type: str = 'GET', body: dict = None) -> dict:
@@ -53,33 +198,46 @@ def make_authorized_request(spotify_user_id: str, url: str, request_type: str =
 
     @param spotify_user_id: user to make request for
     @param url: url to make the request to (including params)
-    @param request_type: Type of request to make. Valid types are
+    @param request_type: Type of request to make. Valid types are 'GET', 'POST', 'PUT', and 'DELETE'
     @param body: Body of request. Only used if `request_type` supports a message body
     @return: HTTP response as dict
     """
-    if request_type == 'GET':
-        request_method = requests.get
-    elif request_type == 'POST':
-        request_method = requests.post
-    elif request_type == 'PUT':
-        request_method = requests.put
-    else:
-        raise ValueError('')
-    res = request_method(url, headers=get_authorization_header(spotify_user_id), json=body)
-    if res.status_code == 401:
-        # "401 Unauthorized" likely means expired token, so try to get a new one
-        if not refresh_tokens(spotify_user_id):
-            # Refreshing token didn't work
-            app.logger.error(f'Couldn\'t refresh token for user: {spotify_user_id}')
-            raise RuntimeError(f'Couldn\'t refresh token for user: {spotify_user_id}')
-        # retry the request
-        res = request_method(url, headers=get_authorization_header(spotify_user_id), json=body)
-    elif res.status_code >= 400:
+    if request_type not in ('GET', 'POST', 'PUT', 'DELETE'):
+        raise ValueError(f'Unsupported request type: {request_type}')
+    scheduler = get_request_scheduler()
+    priority = get_request_priority()
+    max_retries = app.config.get('SPOTIFY_MAX_RETRIES')
+    access_token = get_access_token(spotify_user_id)
+    token_refreshed = False
+    for attempt in range(max_retries + 1):
+        scheduler.acquire(priority)
+        res = spotify_request(request_type, url, headers=get_authorization_header(spotify_user_id, access_token),
+                              json=body)
+        if res.status_code == 401 and not token_refreshed:
+            # "401 Unauthorized" likely means expired token, so try to get a new one
+            if not refresh_tokens(spotify_user_id, access_token):
+                # Refreshing token didn't work
+                app.logger.error(f'Couldn\'t refresh token for user: {spotify_user_id}')
+                raise RuntimeError(f'Couldn\'t refresh token for user: {spotify_user_id}')
+            # retry the request
+            token_refreshed = True
+            access_token = get_access_token(spotify_user_id)
+        elif res.status_code == 429 and attempt < max_retries:
+            # rate limited, hold back every request until Spotify says we can continue
+            retry_after = get_retry_after(res)
+            app.logger.warning(f'Rate limited by Spotify, pausing requests for {retry_after}s')
+            scheduler.pause(retry_after)
+        elif res.status_code >= 500 and request_type in IDEMPOTENT_METHODS and attempt < max_retries:
+            time.sleep(get_backoff_time(attempt))
+        else:
+            break
+
+    if res.status_code >= 400:
         # some other error occurred
         app.logger.error(f'Error making {request_type} request to: {url} for {spotify_user_id}')
         app.logger.error(f'Status code {res.status_code}')
         app.logger.error(f'headers: {res.headers}')
-        app.logger.error(f'Response: {json.dumps(res.json(), indent=2)}')
+        app.logger.error(f'Response: {res.text}')
         raise RuntimeError(f'Error making request to: {url} for {spotify_user_id}')
     try:
         res_data = res.json()
@@ -1,29 +1,50 @@
+import json
+from datetime import date
+from itertools import islice
 from urllib.parse import urlencode
 
-import requests
-from apscheduler.schedulers import SchedulerAlreadyRunningError
 from flask import (
     abort,
     make_response,
     redirect,
     request,
     jsonify,
+    Response,
+    stream_with_context,
 )
 from flask_jwt_extended import create_access_token, create_refresh_token, get_jwt_identity, jwt_required, JWTManager
 
 from server import app
 from . import endpoints, db
-from .database.datamanager import get_user_listening_history, get_user_activities, listening_history_to_dict, \
+from .database.datamanager import get_user_listening_history, get_user_activities, listening_history_to_dicts, \
     get_listening_sessions_for_activity, set_listening_session_activity_by_id, \
-    create_activity, get_songs_for_listening_session, datetime_to_epoch, create_default_activities, delete_activity
-from .database.historytracker import update_user_history
-from .database.playlistmanager import create_playlist, add_songs_from_listening_session_to_playlist
-from .models import SpotifyToken, ListeningSession, Activity
-from .utils.backgroundtasks import start_scheduler
-from .utils.spotifyapiutil import make_authorized_request
+    create_activity, get_songs_for_listening_session, datetime_to_epoch, create_default_activities, delete_activity, \
+    get_user_listening_history_page, iter_user_listening_history, encode_history_cursor, decode_history_cursor, \
+    encode_session_cursor, decode_session_cursor, epoch_to_datetime
+from .database.historytracker import sync_user_history
+from .database.pollqueue import ensure_poll_jobs
+from .database.syncstate import get_sync_state, is_sync_failing
+from .database.statsmanager import get_daily_stats, get_top_artists, get_activity_stats
+from .database.playlistmanager import create_playlist
+from .database.playlistqueue import enqueue_playlist_sync, get_pending_playlist_syncs
+from .models import SpotifyToken, ListeningSession, Activity, PollJob
+from .utils.responsecache import cache_response, cached_response
+from .utils.spotifyapiutil import make_authorized_request, spotify_request, cache_access_token, get_token_expiry
 
 jwt = JWTManager(app)
 
+# default and max number of songs returned per page by /history/
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 500
+# number of songs serialized at a time when streaming /history/
+HISTORY_STREAM_CHUNK_SIZE = 500
+# default and max number of sessions returned per page by /sessions/
+SESSIONS_PAGE_SIZE = 50
+SESSIONS_MAX_PAGE_SIZE = 500
+# default and max number of artists returned by /stats/artists/
+TOP_ARTISTS_COUNT = 10
+TOP_ARTISTS_MAX_COUNT = 100
+
 
 @app.route('/login/')
 def login():
@@ -55,49 +76,69 @@ def callback():
     This endpoint is the callback for the Spotify web API OAuth flow. It handles retrieving the authorization code from
     the url, using the code to get the Spotify access and refresh tokens, and creating tokens for the client.
     """
+    res = spotify_request('POST', endpoints.TOKEN_URL,
+                          auth=(app.config.get('CLIENT_ID'), app.config.get('CLIENT_SECRET')),
+                          data=get_callback_auth_headers(request.args.get('code')))
+    res_data = res.json()
+    check_token_response(res.status_code, res_data)
+
+    headers = {'Authorization': f'Bearer {res_data.get("access_token")}'}
+    me_res = spotify_request('GET', endpoints.ME_URL, headers=headers)
+    return finish_login(me_res.json().get('id'), res_data)
+
+
+def get_callback_auth_headers(code: str) -> dict:
     # Headers for the request to get Spotify tokens
-    auth_headers = {
+    return {
         'grant_type': 'authorization_code',
-        'code': request.args.get('code'),
+        'code': code,
         'redirect_uri': app.config.get('REDIRECT_URI')
     }
 
-    res = requests.post(endpoints.TOKEN_URL,
-                        auth=(app.config.get('CLIENT_ID'), app.config.get('CLIENT_SECRET')),
-                        data=auth_headers)
-    res_data = res.json()
 
-    if res_data.get('error') or res.status_code != 200:
+def check_token_response(status_code: int, res_data: dict) -> None:
+    """
+    Aborts the login if Spotify didn't return tokens
+    """
+    if res_data.get('error') or status_code != 200:
         app.logger.error(
             'Failed to receive token: %s',
             res_data.get('error', 'No error information received.'),
         )
-        abort(res.status_code)
+        abort(status_code)
 
+
+def finish_login(spotify_user_id: str, res_data: dict) -> Response:
+    """
+    Saves a user's Spotify tokens once they've logged in, and creates the tokens the client authenticates with
+    @param spotify_user_id: The user who logged in
+    @param res_data: Spotify's token response
+    """
     # saving the access tokens, along with their spotify user id
     spotify_access_token = res_data.get('access_token')
     spotify_refresh_token = res_data.get('refresh_token')
-    headers = {'Authorization': f'Bearer {spotify_access_token}'}
-    me_res = requests.get(endpoints.ME_URL, headers=headers)
-    me_res_data = me_res.json()
-    spotify_user_id = me_res_data.get('id')
+    expires_at = get_token_expiry(res_data.get('expires_in'))
 
     existing_st = SpotifyToken.query.filter_by(spotify_user_id=spotify_user_id).first()
     if existing_st:
         # Old tokens already exist, so the user has logged in before. Update token
         existing_st.access_token = spotify_access_token
         existing_st.refresh_token = spotify_refresh_token
+        existing_st.expires_at = expires_at
     else:
         # first time user. Create new token and create their default activities
         st = SpotifyToken(
             spotify_user_id=spotify_user_id,
             access_token=spotify_access_token,
-            refresh_token=spotify_refresh_token
+            refresh_token=spotify_refresh_token,
+            expires_at=expires_at
         )
         db.session.add(st)
         create_default_activities(spotify_user_id)
 
     db.session.commit()
+    ensure_poll_jobs([spotify_user_id])
+    cache_access_token(spotify_user_id, spotify_access_token, expires_at)
 
     # Create and return access and refresh tokens for the client to use to authenticate future requests
     client_access_token = create_access_token(identity=spotify_user_id)
@@ -108,34 +149,62 @@ def callback():
 
 @app.route('/sessions/')
 @jwt_required()
+@cache_response('sessions')
 def unlabeled_sessions():
     """
-    Returns all the listening sessions not yet labeled with an activity
+    Returns the listening sessions not yet labeled with an activity, newest first. Takes the url query parameters
+    described in `list_sessions`
     """
-    spotify_user_id = get_jwt_identity()
-    listening_sessions = get_listening_sessions_for_activity(spotify_user_id, None)
-    return {'sessions': [{
-        'id': s.id,
-        'start_time_millis': datetime_to_epoch(s.start_time),
-        'end_time_millis': datetime_to_epoch(s.end_time)
-    } for s in listening_sessions]}
+    return list_sessions(get_jwt_identity(), None)
 
 
 @app.route('/sessions/<activity_id>/')
 @jwt_required()
+@cache_response('sessions')
 def sessions(activity_id):
     """
-    Returns all the listening sessions associated with this activity.
-    The activity is specified by 'activity_id'
+    Returns the listening sessions associated with this activity, newest first.
+    The activity is specified by 'activity_id'. Takes the url query parameters described in `list_sessions`
     """
-    spotify_user_id = get_jwt_identity()
-    activity_id = int(activity_id)
-    listening_sessions = get_listening_sessions_for_activity(spotify_user_id, activity_id)
-    return {'sessions': [{
+    return list_sessions(get_jwt_identity(), int(activity_id))
+
+
+def list_sessions(spotify_user_id: str, activity_id: int | None) -> dict:
+    """
+    Builds a /sessions/ response from the following optional url query parameters:
+    'limit': return one page of at most this many sessions, along with a 'next_before' cursor for the next page
+    'before': the 'next_before' cursor from the previous page
+    'from_millis': only return sessions that end at or after this time
+    'to_millis': only return sessions that start at or before this time
+    Without 'limit' or 'before', all the matching sessions are returned
+    """
+    limit = request.args.get('limit', type=int)
+    before = request.args.get('before')
+    from_millis = request.args.get('from_millis', type=int)
+    to_millis = request.args.get('to_millis', type=int)
+    window_start = epoch_to_datetime(from_millis) if from_millis is not None else None
+    window_end = epoch_to_datetime(to_millis) if to_millis is not None else None
+
+    paginated = limit is not None or before is not None
+    if paginated:
+        try:
+            before = decode_session_cursor(before) if before else None
+        except ValueError:
+            abort(400)
+        limit = max(min(limit or SESSIONS_PAGE_SIZE, SESSIONS_MAX_PAGE_SIZE), 1)
+
+    listening_sessions = get_listening_sessions_for_activity(
+        spotify_user_id, activity_id, limit=limit, before=before, window_start=window_start, window_end=window_end
+    )
+    response = {'sessions': [{
         'id': s.id,
         'start_time_millis': datetime_to_epoch(s.start_time),
         'end_time_millis': datetime_to_epoch(s.end_time)
     } for s in listening_sessions]}
+    if paginated:
+        response['next_before'] = encode_session_cursor(listening_sessions[-1]) \
+            if len(listening_sessions) == limit else None
+    return response
 
 
 @app.route('/set_session_activity/', methods=['POST'])
@@ -145,12 +214,16 @@ def set_session_activity():
     Labels a listening session with an activity, specified by the following url query parameters:
     'session_id': id of the session to modify
     'activity_id': id of the activity to label this session with
+    The activity's playlist is updated in the background, see /playlist_sync_status/
     """
-    spotify_user_id = get_jwt_identity()
     session_id = int(request.args.get('session_id'))
     activity_id = int(request.args.get('activity_id'))
+    previous_activity_id = ListeningSession.query.filter_by(id=session_id).first().activity_id
     set_listening_session_activity_by_id(int(session_id), int(request.args.get('activity_id')))
-    add_songs_from_listening_session_to_playlist(spotify_user_id, int(session_id), activity_id)
+    enqueue_playlist_sync(activity_id)
+    if previous_activity_id is not None and previous_activity_id != activity_id:
+        # the session's songs may need to be removed from the old activity's playlist
+        enqueue_playlist_sync(previous_activity_id)
     return {'result': 'success'}
 
 
@@ -168,7 +241,7 @@ def get_listening_session_songs():
         abort(401)
     listening_session = ListeningSession.query.filter_by(id=session_id).first()
     songs = get_songs_for_listening_session(listening_session)
-    return {'songs': [listening_history_to_dict(song) for song in songs]}
+    return {'songs': listening_history_to_dicts(songs)}
 
 
 @app.route('/activity/create/', methods=['POST'])
@@ -200,6 +273,7 @@ def delete_activity_endpoint():
 
 @app.route('/activities/')
 @jwt_required()
+@cache_response('activities')
 def activities():
     """
     Returns a list of all activities
@@ -231,8 +305,49 @@ def create_playlist_endpoint(activity_id):
     return {'result': 'success'}
 
 
+@app.route('/playlist_sync_status/')
+@jwt_required()
+def playlist_sync_status():
+    """
+    Returns the user's playlists that are waiting to be updated on Spotify
+    """
+    spotify_user_id = get_jwt_identity()
+    return {'pending': [{
+        'playlist_id': job.activity_playlist_id,
+        'requested_at_millis': datetime_to_epoch(job.requested_at),
+        'in_progress': job.lease_owner is not None,
+        'attempts': job.attempts,
+        'last_error': job.last_error
+    } for job in get_pending_playlist_syncs(spotify_user_id)]}
+
+
+@app.route('/sync_status/')
+@jwt_required()
+def sync_status():
+    """
+    Returns how up to date the user's saved listening history is. Times are in milliseconds since the epoch, or null
+    if they haven't happened yet
+    """
+    spotify_user_id = get_jwt_identity()
+    sync_state = get_sync_state(spotify_user_id)
+    poll_job = PollJob.query.filter_by(spotify_user_id=spotify_user_id).first()
+
+    def to_millis(date_time):
+        return datetime_to_epoch(date_time) if date_time is not None else None
+
+    return {
+        'latest_played_at_millis': to_millis(sync_state.latest_played_at) if sync_state else None,
+        'last_synced_at_millis': to_millis(sync_state.last_polled_at) if sync_state else None,
+        'next_sync_at_millis': to_millis(poll_job.next_run_at) if poll_job else None,
+        'failing': is_sync_failing(sync_state) if sync_state else False,
+        'last_error': sync_state.last_error if sync_state else None,
+        'last_error_at_millis': to_millis(sync_state.last_error_at) if sync_state else None
+    }
+
+
 @app.route('/playlists/')
 @jwt_required()
+@cache_response('activities', 'playlists')
 def playlists():
     """
     Returns the playlist information associated with each activity
@@ -245,7 +360,7 @@ def playlists():
         'playlist_url': user_activity.activity_playlist.playlist_url if user_activity.activity_playlist is not None else "",
         'activity_name': user_activity.activity_name,
         'activity_id': user_activity.id
-    } for user_activity in get_user_activities(spotify_user_id)]
+    } for user_activity in get_user_activities(spotify_user_id, with_playlists=True)]
     return {'playlists': playlist_list}
 
 
@@ -256,45 +371,133 @@ def homepage_info():
     Returns the information shown in the previews on the homepage
     """
     spotify_user_id = get_jwt_identity()
+    # sync first, so new songs invalidate the cached response before it's looked up
+    sync_user_history(spotify_user_id)
 
-    user_activities = get_user_activities(spotify_user_id, limit=3)
-    user_activities_dicts = [{
-        'name': activity.activity_name
-    } for activity in user_activities]
-
-    # add activity.name for each activity that has a corresponding playlist
-    all_user_activities = get_user_activities(spotify_user_id)
-    user_playlists_dicts = [activity.activity_name for activity in all_user_activities if activity.activity_playlist is not None]
-    # limit to the first 3 elements
-    user_playlists_dicts = user_playlists_dicts[:3]
-
-    update_user_history(spotify_user_id)
-    user_listening_history = get_user_listening_history(spotify_user_id, limit=3)
-    user_listening_history_dicts = [listening_history_to_dict(lh) for lh in user_listening_history]
-
-    # info is first 3 activities, 3 playlists, and last 3 songs listened to
-    info = {
-        'activities': user_activities_dicts,
-        'playlists': user_playlists_dicts,
-        'history': user_listening_history_dicts
-    }
+    def build_homepage_info():
+        all_user_activities = get_user_activities(spotify_user_id, with_playlists=True)
+        user_activities_dicts = [{
+            'name': activity.activity_name
+        } for activity in all_user_activities[:3]]
+
+        # add activity.name for each activity that has a corresponding playlist
+        user_playlists_dicts = [activity.activity_name for activity in all_user_activities
+                                if activity.activity_playlist is not None]
+        # limit to the first 3 elements
+        user_playlists_dicts = user_playlists_dicts[:3]
+
+        user_listening_history = get_user_listening_history(spotify_user_id, limit=3)
+        user_listening_history_dicts = listening_history_to_dicts(user_listening_history)
+
+        # info is first 3 activities, 3 playlists, and last 3 songs listened to
+        info = {
+            'activities': user_activities_dicts,
+            'playlists': user_playlists_dicts,
+            'history': user_listening_history_dicts
+        }
 
-    return info
+        return info
+
+    return cached_response(spotify_user_id, ['activities', 'playlists', 'history'], build_homepage_info)
+
+
+@app.route('/stats/daily/')
+@jwt_required()
+@cache_response('stats')
+def daily_stats():
+    """
+    Returns the number of songs played on each day (UTC), oldest first. Days without plays are left out. Takes the
+    optional url query parameters 'from' and 'to', the first and last days to include as YYYY-MM-DD
+    """
+    spotify_user_id = get_jwt_identity()
+    try:
+        start = date.fromisoformat(request.args['from']) if 'from' in request.args else None
+        end = date.fromisoformat(request.args['to']) if 'to' in request.args else None
+    except ValueError:
+        abort(400)
+    return {'days': [{
+        'date': stats.day.isoformat(),
+        'play_count': stats.play_count
+    } for stats in get_daily_stats(spotify_user_id, start, end)]}
+
+
+@app.route('/stats/artists/')
+@jwt_required()
+@cache_response('stats')
+def artist_stats():
+    """
+    Returns the artists with the most songs played, most played first. The number of artists is the optional 'limit'
+    url query parameter
+    """
+    spotify_user_id = get_jwt_identity()
+    limit = max(min(request.args.get('limit', TOP_ARTISTS_COUNT, type=int), TOP_ARTISTS_MAX_COUNT), 1)
+    return {'artists': [{
+        'artist_name': stats.artist_name,
+        'play_count': stats.play_count,
+        'last_played_at_millis': datetime_to_epoch(stats.last_played_at)
+    } for stats in get_top_artists(spotify_user_id, limit)]}
+
+
+@app.route('/stats/activities/')
+@jwt_required()
+@cache_response('stats', 'activities')
+def activity_stats():
+    """
+    Returns the number of sessions, songs played and time spent listening for each activity with labeled sessions
+    """
+    spotify_user_id = get_jwt_identity()
+    activity_names = {activity.id: activity.activity_name for activity in get_user_activities(spotify_user_id)}
+    return {'activities': [{
+        'activity_id': stats.activity_id,
+        'activity_name': activity_names.get(stats.activity_id),
+        'session_count': stats.session_count,
+        'play_count': stats.play_count,
+        'listening_seconds': stats.listening_seconds
+    } for stats in get_activity_stats(spotify_user_id)]}
 
 
 @app.route('/history/')
 @jwt_required()
 def history():
     """
-    Return the list of all songs for this user
+    Return the list of all songs for this user, newest first. Takes the following optional url query parameters:
+    'limit': return one page of at most this many songs, along with a 'next_before' cursor for the next page
+    'before': the 'next_before' cursor from the previous page
+    'stream': if 'true', the full history is streamed from the database in chunks instead of built in memory
     """
     spotify_user_id = get_jwt_identity()
-    update_user_history(spotify_user_id)
+    sync_user_history(spotify_user_id)
+
+    limit = request.args.get('limit', type=int)
+    before = request.args.get('before')
+    if limit is not None or before is not None:
+        try:
+            before = decode_history_cursor(before) if before else None
+        except ValueError:
+            abort(400)
+        limit = max(min(limit or HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE), 1)
+        listening_history = get_user_listening_history_page(spotify_user_id, limit, before)
+        next_before = encode_history_cursor(listening_history[-1]) if len(listening_history) == limit else None
+        return {
+            'history_items': listening_history_to_dicts(listening_history),
+            'next_before': next_before
+        }
+
+    if request.args.get('stream') == 'true':
+        def generate_history():
+            yield '{"history_items": ['
+            separator = ''
+            history_iterator = iter_user_listening_history(spotify_user_id)
+            # serialize a chunk at a time, so each chunk's songs are looked up together
+            while chunk := list(islice(history_iterator, HISTORY_STREAM_CHUNK_SIZE)):
+                for lh_dict in listening_history_to_dicts(chunk):
+                    yield separator + json.dumps(lh_dict)
+                    separator = ','
+            yield ']}'
+        return Response(stream_with_context(generate_history()), mimetype='application/json')
+
     listening_history = get_user_listening_history(spotify_user_id)
-    lh_list = []
-    for lh in listening_history:
-        lh_list.append(listening_history_to_dict(lh))
-    return {'history_items': lh_list}
+    return {'history_items': listening_history_to_dicts(listening_history)}
 
 
 @app.route('/user/')
@@ -303,12 +506,6 @@ def user():
     """
     Returns info about the current user's Spotify profile
     """
-    # start the scheduler to handle collecting listening history in the background
-    try:
-        start_scheduler()
-    except SchedulerAlreadyRunningError:
-        pass
-
     spotify_user_id = get_jwt_identity()
 
     return make_authorized_request(spotify_user_id, endpoints.ME_URL)